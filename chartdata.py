@@ -1,4 +1,4 @@
-import os, sys, requests, websocket, json, bisect
+import os, sys, websocket, json, bisect, threading, hashlib, datetime as dt
 import numpy as np, pandas as pd
 import pyqtgraph as pg
 from pyqtgraph import QtCore, QtGui
@@ -30,6 +30,53 @@ TA_LIST = dict(
     Pulse=Struct(momentumN=12, momentumMA=5),
 )
 
+SQUEEZE_ENDED = 0
+SQUEEZE_ON = 1
+SQUEEZE_FIRED = 2
+SQUEEZE_STATES = ['Ended', 'Squeeze', 'Fired']
+
+# Calculated in this order, as each can use the columns of the ones before.
+INDICATORS = ['MA1', 'MA2', 'BB', 'BBOver', 'Trend', 'KC', 'ADX', 'Pulse']
+INDICATOR_DEPS = dict(
+    BBOver=['BB'],
+    KC=['Trend'],
+    Pulse=['BB', 'KC'],
+)
+INDICATOR_COLUMNS = dict(
+    BB=['bbMean', 'bbUpper', 'bbLower'],
+    BBOver=['bbOver'],
+    Trend=['typicalPrice', 'trendTypicalPrice', 'upTrend'],
+    KC=['kcUpper', 'kcLower'],
+    ADX=['adx', 'plusDI', 'minusDI'],
+    Pulse=['momentum', 'slowdown', 'squeezeStates', 'squeezeSteps', 'squeezeDurations'],
+)
+
+def indicatorsNeeded(keys):
+    # The requested indicators plus everything they depend on, in calculation order.
+    needed = set()
+    def add(key):
+        if key in needed:
+            return
+        needed.add(key)
+        for dep in INDICATOR_DEPS.get(key, []):
+            add(dep)
+    for key in keys:
+        add(key)
+    return [key for key in INDICATORS if key in needed]
+
+def indicatorColumns(key):
+    if key in ['MA1', 'MA2']:
+        return ['ma%i' % ma.length for ma in TA_LIST[key]]
+    return INDICATOR_COLUMNS[key]
+
+def indicatorParams(key):
+    # The TA_LIST settings an indicator's values depend on, including those of its dependencies.
+    # Pens only change how it looks so are left out.
+    params = []
+    for ta in wrapList(TA_LIST.get(key, [])):
+        params.append(sorted((k, v) for k, v in ta.__dict__.items() if not k.startswith('pen')))
+    return repr([key, params] + [indicatorParams(dep) for dep in INDICATOR_DEPS.get(key, [])])
+
 def floatToIndex(floatIdx):
     return int(round(floatIdx))
 
@@ -60,18 +107,145 @@ def parseToMarketStruct(string, exchangeAlreadyKnown=None):
                   description=description,
                   timeframe='')
 
-class ChartData(pd.DataFrame):
+def shift(values, periods=1):
+    # Same as pandas Series.shift(), the gap is filled with NaN.
+    ret = np.empty(len(values))
+    ret[:periods] = np.nan
+    ret[periods:] = values[:-periods]
+    return ret
+
+def runLengths(mask):
+    # Number of consecutive True entries ending at each entry, eg: [1 1 0 1] -> [1 2 0 1]
+    counts = np.arange(1, len(mask)+1)
+    lastFalse = np.maximum.accumulate(np.where(mask, 0, counts))
+    return counts - lastFalse
+
+FIRST_MONDAY = 4 * 86400 # 1970-01-05
+
+def resampleBucketIds(times, timeframe):
+    # Bucket number of each epoch time, for timeframes like '4h', '1d', '1w' or '1M'.
+    # Same as pandas resample(closed='right'): intraday and daily buckets include their
+    # end time, weeks (Monday to Sunday) and months are whole calendar periods in UTC.
+    multiple, letter = int(timeframe[:-1]), timeframe[-1]
+    if letter == 'M':
+        months = times.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+        return months // multiple
+    if letter == 'w':
+        return (times - FIRST_MONDAY) // intervalSeconds(timeframe)
+    return -(-times // intervalSeconds(timeframe))
+
+def resampleSeconds(timeframe):
+    # Approximate bucket length, for ordering timeframes
+    if timeframe[-1] == 'M':
+        return int(timeframe[:-1]) * 31 * 86400
+    return intervalSeconds(timeframe)
+
+def resampleNests(fine, coarse):
+    # Whether every bucket of the fine timeframe lies inside a single bucket of the coarse one.
+    kind = lambda timeframe: timeframe[-1] if timeframe[-1] in 'wM' else 'fixed'
+    if kind(fine) != kind(coarse):
+        return False
+    return resampleSeconds(coarse) % resampleSeconds(fine) == 0
+
+def calcSqueezeStates(bbSqueeze, slowdownPrediction, prevState=SQUEEZE_ENDED, prevSteps=0, prevDuration=0):
+    # Squeeze state of every bar, from run lengths rather than stepping through the bars:
+    # Squeeze while the BB is inside the KC, Fired once it leaves, then Ended at the first slowdown.
+    # The prev arguments are the state of the bar before, when continuing on from earlier bars.
+    bars = np.arange(len(bbSqueeze))
+    lastSqueeze = np.maximum.accumulate(np.where(bbSqueeze, bars, -1))
+    hadSqueeze = lastSqueeze >= 0
+
+    stepsSinceSqueeze = runLengths(~bbSqueeze) + np.where(hadSqueeze, 0, prevSteps)
+
+    squeezeRuns = runLengths(bbSqueeze)[lastSqueeze]
+    # A squeeze that was already running before these bars carries on counting.
+    carryDuration = np.where(squeezeRuns == lastSqueeze + 1, 0 if prevSteps else prevDuration, 0)
+    squeezeDuration = np.where(hadSqueeze, squeezeRuns + carryDuration, prevDuration)
+
+    slowdowns = np.cumsum(slowdownPrediction)
+    fired = np.where(hadSqueeze,
+                     slowdowns == slowdowns[lastSqueeze],# No slowdown since the squeeze
+                     (prevState != SQUEEZE_ENDED) & (slowdowns == 0))
+    squeezeState = np.select([bbSqueeze, fired], [SQUEEZE_ON, SQUEEZE_FIRED], SQUEEZE_ENDED)
+
+    return squeezeState, stepsSinceSqueeze, squeezeDuration
+
+def linesPath(x, y1, y2):
+    # Vertical lines from y1 to y2 as one path, which is much faster to build and draw than each line.
+    return pg.arrayToQPath(np.repeat(x, 2), np.column_stack([y1, y2]).ravel(), connect='pairs')
+
+def rectsPath(x1, x2, y1, y2):
+    # Each rectangle is a closed run of 5 points, not connected to the next one.
+    xs = np.column_stack([x1, x2, x2, x1, x1]).ravel()
+    ys = np.column_stack([y1, y1, y2, y2, y1]).ravel()
+    return pg.arrayToQPath(xs, ys, connect=np.tile([1, 1, 1, 1, 0], len(x1)))
+
+RANGE_BLOCK = 64
+TILE_BARS = 512
+DELTA_OVERLAP_BARS = 3 # Cached bars downloaded again, as the last can be incomplete
+gSeriesLocks = {}
+
+def websocketOptions():
+    # websocket doesnt pickup proxy settings from environment, like requests does.
+    options = {}
+    HTTP_PROXY = os.environ.get('HTTP_PROXY')
+    if HTTP_PROXY:
+        from urlparse import urlparse
+        p = urlparse(HTTP_PROXY)
+        options.update(http_proxy_host=p.netloc.split(':')[0], http_proxy_port=p.port)
+    return options
+
+class RangeIndex(object):
+    # Min and max of any slice of a column in constant time, for auto-scaling while panning.
+    # A sparse table over the min/max of each block, plus the partial blocks at either end.
+    def __init__(self, column):
+        self.column = column
+        starts = np.arange(0, len(column), RANGE_BLOCK)
+        self.mins = [np.fmin.reduceat(column, starts)]
+        self.maxs = [np.fmax.reduceat(column, starts)]
+        width = 1
+        while width*2 <= len(starts):
+            self.mins.append(np.fmin(self.mins[-1][:-width], self.mins[-1][width:]))
+            self.maxs.append(np.fmax(self.maxs[-1][:-width], self.maxs[-1][width:]))
+            width *= 2
+
+    def query(self, first, last):
+        # Inclusive of last. NaNs are ignored, like np.nanmin().
+        firstBlock = -(-first // RANGE_BLOCK)
+        endBlock = (last + 1) // RANGE_BLOCK
+        if firstBlock >= endBlock:
+            part = self.column[first:last+1]
+            return np.fmin.reduce(part), np.fmax.reduce(part)
+
+        level = (endBlock - firstBlock).bit_length() - 1
+        other = endBlock - (1 << level)
+        y_min = np.fmin(self.mins[level][firstBlock], self.mins[level][other])
+        y_max = np.fmax(self.maxs[level][firstBlock], self.maxs[level][other])
+        for part in [self.column[first:firstBlock*RANGE_BLOCK], self.column[endBlock*RANGE_BLOCK:last+1]]:
+            if len(part):
+                y_min = np.fmin(y_min, np.fmin.reduce(part))
+                y_max = np.fmax(y_max, np.fmax.reduce(part))
+        return y_min, y_max
+
+class ChartData(object):
     # Static because this is set a few levels above where downloadAndParse is called.
     cacheSeconds = 0
+    # The watchlist refresh turns this off, as its bars are new every time so the indicator cache would only miss.
+    cacheIndicators = True
 
-    def __init__(self, market, existingDf=None):
-        if existingDf is not None:
-            if existingDf is not self:# Watchlist calls __init__ explicitly to fix the subclass.
-                super(ChartData, self).__init__(existingDf)
-        else:
-            super(ChartData, self).__init__(columns=['times', 'open', 'high', 'low', 'close', 'volume'])
+    COLUMNS = ['times', 'open', 'high', 'low', 'close', 'volume']
+
+    def __init__(self, market, existingData=None):
+        if existingData is None:
+            self.allocate()
+        elif existingData is not self:# Watchlist calls __init__ explicitly after unpickling.
+            self.allocate(existingData.count())
+            self.setColumns(existingData.times, existingData.bars)
+            for name in existingData.indicatorRows:
+                self.setIndicator(name, getattr(existingData, name))
 
         self.orderwall = []
+        self.lastTradeTime = 0# Of the newest streamed trade, so late ones don't set the close
         self.isOHLC = False
         self.hasVolume = False
 
@@ -79,7 +253,7 @@ class ChartData(pd.DataFrame):
             return
         self.__dict__.update(market.__dict__)
 
-        if existingDf is not None and self.count():
+        if existingData is not None and self.count():
             self.onDataChange()# We already have a filled ChartData object
             #return # Dont override the interval key - WHY?
 
@@ -94,6 +268,81 @@ class ChartData(pd.DataFrame):
             if lowest != sys.maxint:
                 self.timeframe = str(lowest) + self.timeframe
 
+    # The bars live in contiguous numpy buffers, one row per column, with spare
+    # capacity at the end so bars can be appended without copying every time.
+    # Indicators get their own rows in a separate buffer of the same capacity.
+    def allocate(self, capacity=0):
+        self.size = 0
+        self.timesBuffer = np.zeros(capacity, dtype=np.int64)
+        self.barsBuffer = np.zeros((VOLUME+1, capacity))
+        self.plotTimesBuffer = np.zeros(capacity)
+        self.indicatorBuffer = np.zeros((16, capacity))
+        self.indicatorRows = {}
+
+    def reserve(self, capacity):
+        if capacity <= len(self.timesBuffer):
+            return
+        capacity = max(capacity, 2*len(self.timesBuffer))
+
+        timesBuffer = np.zeros(capacity, dtype=np.int64)
+        timesBuffer[:self.size] = self.times
+        barsBuffer = np.zeros((VOLUME+1, capacity))
+        barsBuffer[:, :self.size] = self.bars
+        plotTimesBuffer = np.zeros(capacity)
+        plotTimesBuffer[:self.size] = self.plotTimes
+        indicatorBuffer = np.zeros((len(self.indicatorBuffer), capacity))
+        indicatorBuffer[:, :self.size] = self.indicatorBuffer[:, :self.size]
+
+        self.timesBuffer, self.barsBuffer = timesBuffer, barsBuffer
+        self.plotTimesBuffer, self.indicatorBuffer = plotTimesBuffer, indicatorBuffer
+
+    def resize(self, size):
+        self.reserve(size)
+        self.size = size
+
+    times = property(lambda self: self.timesBuffer[:self.size])
+    bars = property(lambda self: self.barsBuffer[:, :self.size])# OHLCV rows
+    open = property(lambda self: self.barsBuffer[OPEN, :self.size])
+    high = property(lambda self: self.barsBuffer[HIGH, :self.size])
+    low = property(lambda self: self.barsBuffer[LOW, :self.size])
+    close = property(lambda self: self.barsBuffer[CLOSE, :self.size])
+    volume = property(lambda self: self.barsBuffer[VOLUME, :self.size])
+    plotTimes = property(lambda self: self.plotTimesBuffer[:self.size])
+
+    def setColumns(self, times, bars):
+        self.resize(len(times))
+        self.times[:] = times
+        self.bars[:] = bars
+
+    def setIndicator(self, name, values, start=0):
+        row = self.indicatorRows.get(name)
+        if row is None:
+            row = self.indicatorRows[name] = len(self.indicatorRows)
+            if row == len(self.indicatorBuffer):
+                grown = np.zeros((max(16, 2*row), len(self.timesBuffer)))
+                grown[:row] = self.indicatorBuffer
+                self.indicatorBuffer = grown
+        self.indicatorBuffer[row, start:self.size] = values
+
+    def __getattr__(self, name):
+        # Indicator columns are read as attributes, eg: self.bbMean
+        row = self.__dict__.get('indicatorRows', {}).get(name)
+        if row is None:
+            raise AttributeError(name)
+        return self.indicatorBuffer[row, :self.size]
+
+    def __getstate__(self):
+        # Only pickle the columns, trimmed to size. The watchlist calls __init__ again after unpickling.
+        return dict(size=self.size,
+                    timesBuffer=self.times.copy(),
+                    barsBuffer=self.bars.copy(),
+                    indicatorBuffer=self.indicatorBuffer[:len(self.indicatorRows), :self.size].copy(),
+                    indicatorRows=self.indicatorRows)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.plotTimesBuffer = np.zeros(self.size)
+
     def npZeros(self, cols=1):
         return np.zeros((self.count(), cols))
 
@@ -101,18 +350,25 @@ class ChartData(pd.DataFrame):
         if not tohlcv:
             return
 
-        tohlcv = zip(*tohlcv)
-        for c, col in enumerate(self.columns):
-            self[col] = tohlcv[c]
+        tohlcv = np.array(tohlcv, dtype=float)
+        if tohlcv.shape[1] == 2:
+            # Only a time and a value, eg: Blockchain.info
+            ty = tohlcv
+            tohlcv = np.zeros((len(ty), VOLUME+2))
+            tohlcv[:, 0] = ty[:, 0]
+            tohlcv[:, 1+CLOSE] = ty[:, 1]
+        self.setColumns(tohlcv[:, 0], tohlcv[:, 1:].T)
 
         # Some entries on Google are all 0 except for the close
-        for col in ['open', 'high', 'low']:
-            self.loc[self[col]==0., col] = self.close
+        for col in [OPEN, HIGH, LOW]:
+            row = self.bars[col]
+            zeros = row == 0.
+            row[zeros] = self.close[zeros]
 
         # Yahoo often has currencies upside down
-        ohlcCols = self[['open', 'high', 'low', 'close']]
-        self.high = ohlcCols.max(axis=1)
-        self.low = ohlcCols.min(axis=1)
+        ohlc = self.bars[:CLOSE+1]
+        self.high[:] = ohlc.max(axis=0)
+        self.low[:] = ohlc.min(axis=0)
 
         self.onDataChange()
 
@@ -121,63 +377,170 @@ class ChartData(pd.DataFrame):
                       symbolKey=self.symbolKey,
                       description=self.description,
                       timeframe=self.timeframe)
-    def resampleNew(self, timeframe):# 'D' / 'H'
-        # Convert the integer timestamps in the index to a DatetimeIndex
-        # This interprets the integers as seconds since the Epoch.
-        self.index = pd.to_datetime(self.times, unit='s')
+    def resampleNew(self, timeframe):# '4h' / '1d' / '1w' / '1M'
+        ids = resampleBucketIds(self.times, timeframe)
+
+        # The times are sorted so each bucket is a run of bars, skipping empty buckets.
+        starts = np.flatnonzero(np.diff(ids)) + 1
+        starts = np.r_[0, starts] if self.count() else starts
+        ends = np.r_[starts[1:], self.count()]
+
+        bars = np.zeros((VOLUME+1, len(starts)))
+        if len(starts):
+            bars[OPEN] = self.open[starts]
+            bars[HIGH] = np.maximum.reduceat(self.high, starts)
+            bars[LOW] = np.minimum.reduceat(self.low, starts)
+            bars[CLOSE] = self.close[ends - 1]
+            bars[VOLUME] = np.add.reduceat(self.volume, starts)
 
-        ohlc_dict = dict(times='first', open='first', high='max', low='min', close='last', volume='sum')
-        df = self.resample(timeframe.upper(), how=ohlc_dict, closed='right', label='right')
-        df = df[~df.times.isnull()]# Remove rows with NANs
-
-        df.__class__ = ChartData # Saves a data copy.
         market = self.market()
         market.timeframe = timeframe
-        df.__init__(market, df)
-        return df
+        data = ChartData(market)
+        data.setColumns(self.times[starts], bars)
+        if data.count():
+            data.onDataChange()
+        return data
+
+    def resampleMany(self, timeframes):
+        # Each timeframe is resampled from the finest one already done whose buckets fit
+        # inside its own, eg: 1d from 4h, so the bars are only gone through once.
+        resampled = {}
+        for timeframe in sorted(timeframes, key=resampleSeconds):
+            source = self
+            for done in sorted(resampled, key=resampleSeconds, reverse=True):
+                if resampleNests(done, timeframe):
+                    source = resampled[done]
+                    break
+            resampled[timeframe] = source.resampleNew(timeframe)
+        return [resampled[timeframe] for timeframe in timeframes]
 
     def appendMinuteData(self, minuteDataToCopy):
-        dtCompare = {'d': lambda t: t.date(),
-                     'h': lambda t: (t.date(), t.hour)}[self.timeframe[1]]
-
         dtNow = now()
+        dtStart, period = {
+            'd': lambda t: (dt.datetime(t.year, t.month, t.day), dt.timedelta(days=1)),
+            'h': lambda t: (t.replace(minute=0, second=0, microsecond=0), dt.timedelta(hours=1)),
+        }[self.timeframe[1]](dtNow)
+        periodStart, periodEnd = timestamp(dtStart), timestamp(dtStart + period)
+
         #resampled = self.resampleNew(self.timeframe[1].upper())#FIXME
-        ohlcv = minuteDataToCopy.calcOHLCForPeriod(dtNow, dtCompare)
-        if ohlcv[LOW] == sys.float_info.max:
+        ohlcv = minuteDataToCopy.calcOHLCForPeriod(periodStart, periodEnd)
+        if ohlcv is None:
             return
 
         tohlcv = [timestamp(dtNow)] + ohlcv
-        if self.count() and dtCompare(fromtimestamp(self.times.iloc[-1])) == dtCompare(dtNow):
-            # Replace last OHLC entry
-            self.iloc[-1] = tohlcv
+        if self.count() and periodStart <= self.times[-1] < periodEnd:
+            self.replaceLastBar(tohlcv)
         else:
-            # Append OHLC entry
-            self.loc[self.count()] = tohlcv
+            self.appendBar(tohlcv)
+
+    def mergeCachedSeries(self, cached, windowStart):
+        # Put the cached bars from windowStart on before the downloaded ones, so the series covers
+        # the same window as a full download. Returns False if there's a gap between them.
+        if not cached or not len(cached.times):
+            return True
+        if self.count() and self.times[0] > cached.times[-1]:
+            return False
 
-        self.onDataChange()
+        first = np.searchsorted(cached.times, windowStart)
+        end = np.searchsorted(cached.times, self.times[0]) if self.count() else len(cached.times)# Nothing new, eg: at the weekend
+        if first < end:
+            self.setColumns(np.r_[cached.times[first:end], self.times], np.c_[cached.bars[:, first:end], self.bars])
+            self.onDataChange()
+        return True
+
+    def addTrades(self, trades):
+        # Live trades of [time, price, amount] update the last bar, or start a new one
+        # when they're past its interval. Then everything after the first changed bar is updated.
+        # Returns the index of the first changed bar, or None if none changed.
+        interval = intervalSeconds(self.timeframe)
+        start = None
+        for time, price, amount in sorted(trades):
+            barTime = time - time % interval
+            if self.count() and barTime < self.times[-1]:
+                continue# Late, so already in the downloaded bars
+            if not self.count() or barTime > self.times[-1]:
+                self.resize(self.count() + 1)
+                self.times[-1] = barTime
+                self.bars[:, -1] = [price, price, price, price, 0.]
+            e = self.count() - 1
+            self.high[e] = max(self.high[e], price)
+            self.low[e] = min(self.low[e], price)
+            if time >= self.lastTradeTime:
+                self.close[e] = price
+                self.lastTradeTime = time
+            self.volume[e] += amount
+            start = e if start is None else start
+
+        if start is not None:
+            self.onTailChange(start)
+        return start
+
+    def appendBar(self, tohlcv):
+        self.resize(self.count() + 1)
+        self.replaceLastBar(tohlcv)
+
+    def replaceLastBar(self, tohlcv):
+        self.times[-1] = tohlcv[0]
+        self.bars[:, -1] = tohlcv[1:]
+        self.onTailChange(self.count() - 1)
 
     def onDataChange(self):
         if self.exchange.filterGaps:
-            avgInterval = (self.times.iloc[-1] - self.times[0]) / self.count()
+            avgInterval = float(self.times[-1] - self.times[0]) / self.count()
             self.timeInterval = avgInterval
-            # Yahoo has weekend gaps etc
-            self.plotTimes = [self.times[0] + avgInterval*i for i in xrange(self.count())]
         else:
             # Calculate modal average interval, in case data has gaps
-            self.timeInterval = float((self.times - self.times.shift(1)).mode())
-            self.plotTimes = self.times
+            intervals, counts = np.unique(np.diff(self.times), return_counts=True)
+            self.timeInterval = float(intervals[counts.argmax()]) if len(counts) else 0.
+        self.updatePlotTimes(0)
 
         self.isOHLC = self.high.max() != 0.
         self.hasVolume = self.volume.max() > 0.
 
-        self.candleStickPictures = [[None]*2, [None]*2]
-        self.calculatedIndicators = False
+        self.candleStickPictures = {}
+        self.candlestickRanges = {}
+        self.rangeIndexes = {}
+        self.calculatedIndicators = set()
+
+    def onTailChange(self, start):
+        # Only the bars from start on have been replaced or appended, so just
+        # update the end of everything calculated from them.
+        if start < 2 or not self.timeInterval:
+            self.onDataChange()
+            return
+
+        # The time interval is kept until the next full change, so the earlier bars dont move.
+        self.updatePlotTimes(start)
+
+        self.isOHLC |= self.high[start:].max() != 0.
+        self.hasVolume |= self.volume[start:].max() > 0.
+
+        # Only the tiles from the first changed bar on need drawing again
+        for key in self.candleStickPictures.keys():
+            isVolume, showTrendBars, bucket, tile = key
+            if (tile + 1) * TILE_BARS * bucket > start:
+                del self.candleStickPictures[key]
+        # The candlesticks can only have grown, as a replaced bar is rarely smaller than before
+        for isVolume, (y1, y2) in self.candlestickRanges.items():
+            tail = self.candlestickColumns(isVolume)[:, start:]
+            self.candlestickRanges[isVolume] = min(y1, tail.min()), max(y2, tail.max())
+        self.rangeIndexes = {}
+        if self.calculatedIndicators:
+            self.calcIndicators(start, self.calculatedIndicators)
+            self.makePlots(self.calculatedIndicators, start)
+
+    def updatePlotTimes(self, start):
+        if self.exchange.filterGaps:
+            # Yahoo has weekend gaps etc
+            self.plotTimes[start:] = self.times[0] + self.timeInterval*np.arange(start, self.count())
+        else:
+            self.plotTimes[start:] = self.times[start:]
 
     def getOHLCV(self, e):
-        return self.open[e], self.high[e], self.low[e], self.close[e], self.volume[e]
+        return tuple(self.bars[:, e])
 
     def count(self):
-        return len(self.times)
+        return self.size
 
     def clampIndex(self, floatIdx, inclusive=True):
         idx = floatToIndex(floatIdx)
@@ -190,110 +553,155 @@ class ChartData(pd.DataFrame):
         return self.times[self.clampIndex(idx)]
 
     def findTimeIndex(self, time):
-        return self.times.searchsorted(time)[0]
+        return int(self.times.searchsorted(time))
+
+    def findRange(self, names, first, last):
+        # The y-range of the named columns between the bar indexes, inclusive.
+        y_min, y_max = np.nan, np.nan
+        for name in wrapList(names):
+            if name not in self.rangeIndexes:
+                self.rangeIndexes[name] = RangeIndex(getattr(self, name))
+            column_min, column_max = self.rangeIndexes[name].query(first, last)
+            y_min = np.fmin(y_min, column_min)
+            y_max = np.fmax(y_max, column_max)
+
+        if np.isnan(y_min) or np.isnan(y_max):
+            return None
+        return y_min, y_max
 
     def unfilterIndex(self, time):
         ret = int((time - self.times[0]) / self.timeInterval)
         return ret
 
-    def calcOHLCForPeriod(self, dtForDay, dtCompare):
+    def calcOHLCForPeriod(self, periodStart, periodEnd):
+        # The times are sorted, so the bars in [periodStart, periodEnd) are a slice.
+        first, last = self.times.searchsorted([periodStart, periodEnd])
+        if first == last:
+            return None
+
+        bars = self.bars[:, first:last]
         ohlcv = [0.]*(VOLUME+1)
-        ohlcv[HIGH] = -sys.float_info.max
-        ohlcv[LOW] = sys.float_info.max
+        ohlcv[OPEN] = bars[OPEN, 0]
+        ohlcv[HIGH] = bars[HIGH].max()
+        ohlcv[LOW] = bars[LOW].min()
+        ohlcv[CLOSE] = bars[CLOSE, -1]
+        ohlcv[VOLUME] = bars[VOLUME].sum()
+        return ohlcv
 
-        for e in xrange(self.count()):
-            time = fromtimestamp(self.times[e])
-            if dtCompare(time) != dtCompare(dtForDay):
-                continue
+    def lookbackSlice(self, start, lookback):
+        # The bars needed to recalculate from start, for an indicator looking back this many bars.
+        return slice(max(0, start - lookback), self.count())
 
-            if ohlcv[OPEN] == 0.:
-                ohlcv[OPEN] = self.open[e]
-            ohlcv[CLOSE] = self.close[e]
-            ohlcv[HIGH] = max(ohlcv[HIGH], self.high[e])
-            ohlcv[LOW] = min(ohlcv[LOW], self.low[e])
-            ohlcv[VOLUME] += self.volume[e]
+    def setIndicatorTail(self, name, values, start, sl):
+        # values were calculated for the bars in sl, only store the ones from start on.
+        self.setIndicator(name, values[start - sl.start:], start)
 
-        return ohlcv
-
-    def calcPulse(self, momentumN, momentumMA, **unused):
-        retMomentum = self.npZeros()
-        pensMomentum = []
-        bbInside, bbOutside = [], []
+    def calcMA(self, start, ta):
+        kwds = dict(min_periods=0)
+        sl = self.lookbackSlice(start, max(ma.length for ma in ta))
+        for ma in ta:
+            self.setIndicatorTail('ma%i' % ma.length, pd.rolling_mean(self.close[sl], ma.length, **kwds), start, sl)
+    calcMA1 = calcMA2 = calcMA
 
-        self.squeezeDuration = 0
-        self.stepsSinceSqueeze = 0
-        self.squeezeState = 'Ended'
+    def calcBB(self, start, ta):
+        kwds = dict(min_periods=0)
+        sl = self.lookbackSlice(start, ta.length)
+        std = pd.rolling_std(self.close[sl], ta.length, **kwds)
+        if sl.start == 0:
+            std[0] = 0. # Dont want Nan in first entry
+        bbMean = pd.rolling_mean(self.close[sl], ta.length, **kwds)
+        self.setIndicatorTail('bbMean', bbMean, start, sl)
+        self.setIndicatorTail('bbUpper', bbMean + ta.stdDevMult*std, start, sl)
+        self.setIndicatorTail('bbLower', bbMean - ta.stdDevMult*std, start, sl)
+
+    def calcBBOver(self, start, ta):
+        sl = self.lookbackSlice(start, 0)
+        bbLower = self.bbLower[sl]
+        denom = self.bbUpper[sl] - bbLower
+        denom = np.select([denom==0., True], [1., denom])
+        bbOver = (self.close[sl] - bbLower) / denom
+        self.setIndicatorTail('bbOver', bbOver * 2. - 1.0, start, sl) # Range [-1 1]
+
+    def calcTrend(self, start, ta):
+        sl = self.lookbackSlice(start, 6)
+        typicalPrice = (self.high[sl] + self.low[sl] + self.close[sl]) / 3.
+        trendTypicalPrice = pd.rolling_mean(typicalPrice, 6)
+        self.setIndicatorTail('typicalPrice', typicalPrice, start, sl)
+        self.setIndicatorTail('trendTypicalPrice', trendTypicalPrice, start, sl)
+        self.setIndicatorTail('upTrend', self.close[sl] >= trendTypicalPrice, start, sl)
+
+    def calcKC(self, start, ta):
+        kwds = dict(min_periods=0)
+        sl = self.lookbackSlice(start, ta.length)
+        midLine = pd.rolling_mean(self.typicalPrice[sl], ta.length, **kwds)
+        meanRange = pd.rolling_mean(self.high[sl] - self.low[sl], ta.length, **kwds)
+        self.setIndicatorTail('kcUpper', midLine+ta.hlRangeMult*meanRange, start, sl)
+        self.setIndicatorTail('kcLower', midLine-ta.hlRangeMult*meanRange, start, sl)
+
+    def calcPulse(self, start, ta):
+        sl = self.lookbackSlice(start, ta.momentumN + ta.momentumMA)
+        close = self.close[sl]
+        bbUpper, bbLower = self.bbUpper[sl], self.bbLower[sl]
+        kcUpper, kcLower = self.kcUpper[sl], self.kcLower[sl]
 
         # Decreasing width is an early sign the momentum will soon slowdown.
-        bbWidth = self.bbUpper - self.bbLower
-        kcWidth = self.kcUpper - self.kcLower
-        bbSqueeze = (self.bbUpper < self.kcUpper) & (self.bbLower > self.kcLower)
+        bbWidth = bbUpper - bbLower
+        kcWidth = kcUpper - kcLower
+        bbSqueeze = (bbUpper < kcUpper) & (bbLower > kcLower)
 
         if 0:
             # Show rate of bollinger's expansion
-            bbWidthLast = bbWidth.shift(1)
+            bbWidthLast = shift(bbWidth)
             momentum = (bbWidth - bbWidthLast) / bbWidthLast
             momentum[0:20] = 0.# Can be wild before the bollinger is finished
             momentum[momentum < 0.] = 0.
-            momentum[self.close < self.bbMean] *= -1.
+            momentum[close < self.bbMean[sl]] *= -1.
         else:
             # Show real momentum
-            momentum = self.close.diff(momentumN)
-            momentum[momentum.isnull()] = 0.
-            momentum = pd.rolling_mean(momentum, momentumMA)
+            momentum = close - shift(close, ta.momentumN)
+            momentum[np.isnan(momentum)] = 0.
+            momentum = pd.rolling_mean(momentum, ta.momentumMA)
 
         width = bbWidth / kcWidth
-        slowdownPrediction = abs(width.shift(1)) > abs(width)
+        slowdownPrediction = abs(shift(width)) > abs(width)
 
-        prevWidth = 0.
-        for e in xrange(self.count()):
-            time = self.plotTimes[e]
+        self.setIndicatorTail('momentum', momentum, start, sl)
+        self.setIndicatorTail('slowdown', slowdownPrediction, start, sl)
 
-            # Dots for BB squeeze
-            if bbSqueeze[e]:
-                self.squeezeState = 'Squeeze'
-
-                if self.stepsSinceSqueeze:
-                    self.stepsSinceSqueeze = 0
-                    self.squeezeDuration = 0
-
-                self.squeezeDuration += 1
-                bbInside.append(time)
-            else:
-                if self.squeezeState == 'Squeeze':
-                    self.squeezeState = 'Fired'
-
-                self.stepsSinceSqueeze += 1
-                bbOutside.append(time)
-
-            # Momentum histogram with faded colors when we are predicting a slowdown.
-            pen = [0,255,0] if momentum[e] >= 0. else [255,0,0]
-            if slowdownPrediction[e]:
-                pen = [c/2 for c in pen]
-                if self.squeezeState == 'Fired':
-                    self.squeezeState = 'Ended'
-            pensMomentum.append(pen)
-
-        if self.squeezeState != 'Squeeze':
+        # Carry on the squeeze state from the bar before start.
+        if start:
+            prev = [self.squeezeStates[start-1], self.squeezeSteps[start-1], self.squeezeDurations[start-1]]
+        else:
+            prev = [SQUEEZE_ENDED, 0, 0]
+        tail = start - sl.start
+        states = calcSqueezeStates(bbSqueeze[tail:], slowdownPrediction[tail:], *prev)
+        for name, values in zip(['squeezeStates', 'squeezeSteps', 'squeezeDurations'], states):
+            self.setIndicator(name, values, start)
+
+    def setSqueezeStats(self):
+        self.stepsSinceSqueeze = int(self.squeezeSteps[-1])
+        self.squeezeDuration = int(self.squeezeDurations[-1])
+        state = int(self.squeezeStates[-1])
+        self.squeezeState = SQUEEZE_STATES[state]
+        if state != SQUEEZE_ON:
             self.squeezeState += ' (%i)' % self.stepsSinceSqueeze
 
-        return momentum, pensMomentum, bbInside, bbOutside
+    def calcADX(self, start, ta):
+        # The ADX averages the DI, which are averages themselves.
+        sl = self.lookbackSlice(start, 2*ta.length)
+        high, low, close = self.high[sl], self.low[sl], self.close[sl]
 
-    def calcADX(self, length, **unused):
+        prevClose = shift(close)
+        trueRange = np.fmax(high - low, abs(high - prevClose))
+        trueRange = np.fmax(trueRange, abs(low - prevClose))
 
-        trueRange = pd.DataFrame()
-        trueRange[0] = self.high - self.low
-        trueRange[1] = abs(self.high - self.close.shift(1))
-        trueRange[2] = abs(self.low - self.close.shift(1))
-        trueRange = trueRange.max(axis=1)
-
-        upMove = self.high - self.high.shift(1)
-        downMove = self.low.shift(1) - self.low
+        upMove = high - shift(high)
+        downMove = shift(low) - low
 
         plusDM = np.where((upMove > downMove) & (upMove > 0.), upMove, 0.)
         minusDM = np.where((downMove > upMove) & (downMove > 0.), downMove, 0.)
 
-        kwds = dict(window=length, min_periods=0)
+        kwds = dict(window=ta.length, min_periods=0)
         atr = pd.rolling_mean(trueRange, **kwds)
         plusDI = 100. * pd.rolling_mean(plusDM, **kwds) / atr
         minusDI = 100. * pd.rolling_mean(minusDM, **kwds) / atr
@@ -302,36 +710,79 @@ class ChartData(pd.DataFrame):
         finalCalc[0] = 0.
         adx = 100. * pd.rolling_mean(finalCalc, **kwds)
 
-        ret = pd.DataFrame()
-        ret[0] = adx
-        ret[1] = plusDI
-        ret[2] = minusDI
+        self.setIndicatorTail('adx', adx, start, sl)
+        self.setIndicatorTail('plusDI', plusDI, start, sl)
+        self.setIndicatorTail('minusDI', minusDI, start, sl)
+
+    def calcIndicators(self, start=0, keys=INDICATORS):
+        # Every indicator is calculated from the bars and the indicators it depends on,
+        # so when only the last bars have changed just their values are recalculated.
+        # keys must already include the dependencies that arent calculated, see indicatorsNeeded().
+        useCache = start == 0 and ChartData.cacheIndicators and getattr(self, 'exchange', None)
+        dataHash = self.dataHash() if useCache else None
+        for key in [key for key in INDICATORS if key in keys]:
+            if useCache and self.loadIndicator(key, dataHash):
+                continue
+            getattr(self, 'calc' + key)(start, TA_LIST.get(key))
+            if useCache:
+                self.saveIndicator(key, dataHash)
 
-        return ret.values
+    def indicatorCacheKey(self, key):
+        return self.chartCacheKey()[:-1] + ['indicators', key]
 
-    def calcIndicatorsMakePlots(self):
+    def dataHash(self):
+        # Every bar, as earlier ones can be revised, eg: Yahoo adjusting for splits and dividends.
+        h = hashlib.sha1(self.times.tostring())
+        h.update(self.bars.tostring())
+        return h.hexdigest()
+
+    def indicatorFingerprint(self, key, dataHash):
+        return (self.count(), dataHash, indicatorParams(key))
+
+    def loadIndicator(self, key, dataHash):
+        cached = gCache.get(self.indicatorCacheKey(key))
+        if not cached or cached.value.fingerprint != self.indicatorFingerprint(key, dataHash):
+            return False
+        for name, values in cached.value.columns.items():
+            self.setIndicator(name, values)
+        return True
+
+    def saveIndicator(self, key, dataHash):
+        columns = dict((name, getattr(self, name).copy()) for name in indicatorColumns(key))
+        gCache.set(self.indicatorCacheKey(key), Struct(fingerprint=self.indicatorFingerprint(key, dataHash), columns=columns))
+
+    def calcIndicatorsMakePlots(self, keys=INDICATORS):
+        # Only calculates the requested indicators that havent been already.
         if not self.count():
             return
 
-        if self.calculatedIndicators:
+        keys = [key for key in indicatorsNeeded(keys) if key not in self.calculatedIndicators]
+        if not keys:
             return
 
+        self.calcIndicators(0, keys)
+        self.calculatedIndicators.update(keys)
+        self.makePlots(keys)
+
+    def makePlots(self, keys=INDICATORS, start=0):
+        # The line plots are views of the indicator columns so cost nothing to make again,
+        # but the Pulse pens and squeeze dots are built up, so only from start when the tail changes.
         class TAPlot():
             def __init__(self, **kwds):
                 self.extraTA = False
                 self.barGraph = False
                 self.__dict__.update(kwds)
 
-        kwds = dict(min_periods=0)
-
         self.taVWAP = []
         for key in ['MA1', 'MA2']:
+            if key not in keys:
+                continue
             setattr(self, 'ta' + key, [])
             for ma in TA_LIST[key]:
                 getattr(self, 'ta' + key).append(TAPlot(
                     name='MA %i' % ma.length,
                     pen=ma.pen,
-                    yColumns=pd.rolling_mean(self.close, ma.length, **kwds)))
+                    yColumns=getattr(self, 'ma%i' % ma.length)))
 
                 if not self.hasVolume:
                     continue# Cant do VWAP without volume
@@ -340,159 +791,227 @@ class ChartData(pd.DataFrame):
                 self.taVWAP.append(TAPlot(
                     name='VWAP %i' % ma.length,
                     pen=(c/2 for c in ma.pen['color']),
-                    yColumns=pd.rolling_mean(self.close, ma.length, **kwds)))
-
-        ta = TA_LIST['BB']
-        std = pd.rolling_std(self.close, ta.length, **kwds)
-        std[0] = 0. # Dont want Nan in first entry
-        self['bbMean'] = pd.rolling_mean(self.close, ta.length, **kwds)
-        self['bbUpper'] = self.bbMean + ta.stdDevMult*std
-        self['bbLower'] = self.bbMean - ta.stdDevMult*std
-        self.taBB = TAPlot(
-            name='BB %i, %g' % (ta.length, ta.stdDevMult),
-            pen=ta.pen,
-            yColumns=[self.bbUpper, self.bbMean, self.bbLower])
-
-        denom = 2*ta.stdDevMult*std # == bbUpper - bbLower
-        denom = np.select([denom==0., True], [1., denom])
-        bbOver = (self.close - self.bbLower) / denom
-        self['bbOver'] = bbOver * 2. - 1.0 # Range [-1 1]
-
-        ta = TA_LIST['BBOver']
-        self.taBBOver = TAPlot(
-            name='BB Overbought/Oversold',
-            pen=ta.pen,
-            extraTA=True,
-            yColumns=self.bbOver)
-
-        self['typicalPrice'] = (self.high + self.low + self.close) / 3.
-        self['trendTypicalPrice'] = pd.rolling_mean(self.typicalPrice, 6)
-        self['upTrend'] = self.close >= self.trendTypicalPrice
-
-        ta = TA_LIST['KC']
-        midLine = pd.rolling_mean(self.typicalPrice, ta.length, **kwds)
-        meanRange = pd.rolling_mean(self.high - self.low, ta.length, **kwds)
-
-        self['kcUpper'] = midLine+ta.hlRangeMult*meanRange
-        self['kcLower'] = midLine-ta.hlRangeMult*meanRange
-        self.taKC = TAPlot(
-            name='KC %i, %g' % (ta.length, ta.hlRangeMult),
-            pen=ta.pen,
-            yColumns=[self.kcUpper, self.kcLower])
-
-        ta = TA_LIST['ADX']
-        yColumns = self.calcADX(**ta.__dict__)
-        self.taADX = [
-            TAPlot(
-                name='ADX %i' % ta.length,
-                pen=ta.penADX,
+                    yColumns=getattr(self, 'ma%i' % ma.length)))
+
+        if 'BB' in keys:
+            ta = TA_LIST['BB']
+            self.taBB = TAPlot(
+                name='BB %i, %g' % (ta.length, ta.stdDevMult),
+                pen=ta.pen,
+                yColumns=[self.bbUpper, self.bbMean, self.bbLower])
+
+        if 'BBOver' in keys:
+            ta = TA_LIST['BBOver']
+            self.taBBOver = TAPlot(
+                name='BB Overbought/Oversold',
+                pen=ta.pen,
                 extraTA=True,
-                yColumns=yColumns[:, 0]),
-            TAPlot(
-                name='+DI %i' % ta.length,
-                pen=ta.penPlusDI,
-                extraTA=True,
-                yColumns=yColumns[:, 1]),
-            TAPlot(
-                name='-DI %i' % ta.length,
-                pen=ta.penMinusDI,
-                extraTA=True,
-                yColumns=yColumns[:, 2]),
-        ]
-
-        ta = TA_LIST['Pulse']
-        momentum, pensMomentum, bbInside, bbOutside = self.calcPulse(**ta.__dict__)
-        bbCommon = dict(
-            pen=None,# disable line drawing between points
-            symbol='o',
-            symbolSize=8,
-            symbolPen=None,
-            extraTA=True,
-        )
-        self.taPulse = [
-            TAPlot(
-                name='Pulse Momentum',
-                extraTA=True,
-                barGraph=True,
-                yColumns=momentum,
-                pens=pensMomentum,
-                brushes=pensMomentum),
-            TAPlot(
-                name='BB Outside',
-                x=bbOutside,
-                yColumns=np.zeros((len(bbOutside),)),
-                symbolBrush=(0,255,255),
-                **bbCommon),
-            TAPlot(
-                name='BB Inside',
-                x=bbInside,
-                yColumns=np.zeros((len(bbInside),)),
-                symbolBrush=(255,0,0),
-                **bbCommon),
-        ]
-
-        self.calculatedIndicators = True
+                yColumns=self.bbOver,
+                yNames='bbOver')
+
+        if 'KC' in keys:
+            ta = TA_LIST['KC']
+            self.taKC = TAPlot(
+                name='KC %i, %g' % (ta.length, ta.hlRangeMult),
+                pen=ta.pen,
+                yColumns=[self.kcUpper, self.kcLower])
+
+        if 'ADX' in keys:
+            ta = TA_LIST['ADX']
+            self.taADX = [
+                TAPlot(
+                    name='ADX %i' % ta.length,
+                    pen=ta.penADX,
+                    extraTA=True,
+                    yColumns=self.adx,
+                    yNames='adx'),
+                TAPlot(
+                    name='+DI %i' % ta.length,
+                    pen=ta.penPlusDI,
+                    extraTA=True,
+                    yColumns=self.plusDI),
+                TAPlot(
+                    name='-DI %i' % ta.length,
+                    pen=ta.penMinusDI,
+                    extraTA=True,
+                    yColumns=self.minusDI),
+            ]
+
+        if 'Pulse' in keys:
+            self.setSqueezeStats()
+
+            if not start or not hasattr(self, 'taPulse'):
+                start = 0
+                pensMomentum, bbInside, bbOutside = [], np.zeros(0), np.zeros(0)
+            else:
+                pensMomentum = self.taPulse[0].pens
+                bbOutside, bbInside = self.taPulse[1].x, self.taPulse[2].x
+            del pensMomentum[start:]
+            startTime = self.plotTimes[start]
+            bbOutside = bbOutside[:bbOutside.searchsorted(startTime)]
+            bbInside = bbInside[:bbInside.searchsorted(startTime)]
 
-    # data must have fields: time, open, close, min, max, volume
-    def createCandlestick(self, isVolume, showTrendBars):
-        if not self.isOHLC: return
-        if isVolume and not self.hasVolume: return
+            # Dots for BB squeeze
+            bbSqueeze = self.squeezeStates[start:] == SQUEEZE_ON
+            bbInside = np.r_[bbInside, self.plotTimes[start:][bbSqueeze]]
+            bbOutside = np.r_[bbOutside, self.plotTimes[start:][~bbSqueeze]]
 
-        picture = self.candleStickPictures[isVolume][showTrendBars]
-        if picture:
-            return picture
+            # Momentum histogram with faded colors when we are predicting a slowdown.
+            pens = np.where((self.momentum[start:] >= 0.)[:, np.newaxis], [0,255,0], [255,0,0])
+            pens[self.slowdown[start:] != 0.] //= 2
+            pensMomentum += pens.tolist()
+
+            bbCommon = dict(
+                pen=None,# disable line drawing between points
+                symbol='o',
+                symbolSize=8,
+                symbolPen=None,
+                extraTA=True,
+            )
+            self.taPulse = [
+                TAPlot(
+                    name='Pulse Momentum',
+                    extraTA=True,
+                    barGraph=True,
+                    yColumns=self.momentum,
+                    yNames='momentum',
+                    pens=pensMomentum,
+                    brushes=pensMomentum),
+                TAPlot(
+                    name='BB Outside',
+                    x=bbOutside,
+                    yColumns=np.zeros((len(bbOutside),)),
+                    symbolBrush=(0,255,255),
+                    **bbCommon),
+                TAPlot(
+                    name='BB Inside',
+                    x=bbInside,
+                    yColumns=np.zeros((len(bbInside),)),
+                    symbolBrush=(255,0,0),
+                    **bbCommon),
+            ]
+
+    def tileCount(self, bucket):
+        tileBars = TILE_BARS * bucket
+        return (self.count() + tileBars - 1) // tileBars
 
+    # data must have fields: time, open, close, min, max, volume
+    def createCandlestick(self, isVolume, showTrendBars, bucket=1, tiles=None):
+        # The pictures for each tile of TILE_BARS bars, all of them by default.
+        # Tiles are cached separately, so only the last needs drawing again when the last bars change.
+        if not self.isOHLC: return []
+        if isVolume and not self.hasVolume: return []
+        if showTrendBars:
+            self.calcIndicatorsMakePlots(['Trend'])
+
+        if tiles is None:
+            tiles = range(self.tileCount(bucket))
+
+        pictures = []
+        for tile in tiles:
+            key = (isVolume, showTrendBars, bucket, tile)
+            if key not in self.candleStickPictures:
+                self.candleStickPictures[key] = self.createCandlestickTile(isVolume, showTrendBars, bucket, tile)
+            pictures.append(self.candleStickPictures[key])
+        return pictures
+
+    def createCandlestickTile(self, isVolume, showTrendBars, bucket, tile):
         picture = QtGui.QPicture()
         p = QtGui.QPainter(picture)
 
-        w = self.timeInterval / 3.
-        for e in xrange(self.count()):
-            t = self.plotTimes[e]
-            open, high, low, close, volume = self.getOHLCV(e)
-
-            upBar = close >= open
-            if showTrendBars:
-                upTrend = self.upTrend[e]
-                color = 'cyan' if upTrend else 'red'
-            else:
-                color = OPEN_CLOSE_COLOR[upBar]
-            color = color[0]
+        tileBars = TILE_BARS * bucket
+        t, bars, last = self.combineBars(bucket, tile * tileBars, (tile + 1) * tileBars)
+        open, high, low, close, volume = bars
+        w = self.timeInterval * bucket / 3.
 
-            p.setPen(pg.mkPen(color))
-            if showTrendBars and upTrend == upBar:
-                p.setBrush(pg.mkBrush(color))# Solid body
-            else:
-                p.setBrush(pg.mkBrush('#000000'))# Make the body hollow
+        upBar = close >= open
+        if showTrendBars:
+            upTrend = self.upTrend[last] != 0.
+            colors = np.where(upTrend, 'cyan', 'red')
+            solid = upTrend == upBar
+        else:
+            colors = np.array(OPEN_CLOSE_COLOR)[upBar.astype(int)]
+            solid = np.zeros(len(t), dtype=bool)
 
-            if isVolume:
-                y = 0.
-                height = volume
-            else:
-                # Candlestick
-                if low != high:# Weird long lines can happen on 5m Yahoo if the OHLC is all the same
-                    p.drawLine(QtCore.QPointF(t, low), QtCore.QPointF(t, high))
-                y = open
-                height = close - open
+        if isVolume:
+            y = np.zeros(len(t))
+            height = volume
+        else:
+            y = open
+            height = close - open
+
+        # Draw all the bars with the same pen and brush in one go.
+        for color in np.unique(colors):
+            for isSolid in [False, True]:
+                group = (colors == color) & (solid == isSolid)
+                if not group.any():
+                    continue
 
-            p.drawRect(QtCore.QRectF(t-w, y, w*2, height))
+                p.setPen(pg.mkPen(color[0]))
+                if isSolid:
+                    p.setBrush(pg.mkBrush(color[0]))# Solid body
+                else:
+                    p.setBrush(pg.mkBrush('#000000'))# Make the body hollow
 
-        p.end()
+                if not isVolume:
+                    # Weird long lines can happen on 5m Yahoo if the OHLC is all the same
+                    wicks = group & (low != high)
+                    if wicks.any():
+                        p.drawPath(linesPath(t[wicks], low[wicks], high[wicks]))
+
+                p.drawPath(rectsPath(t[group]-w, t[group]+w, y[group], y[group]+height[group]))
 
-        self.candleStickPictures[isVolume][showTrendBars] = picture
+        p.end()
         return picture
 
+    def combineBars(self, bucket, first=0, end=None):
+        # Each run of bucket bars from first to end becomes one bar, for when many bars are drawn to a pixel.
+        # Also returns the index of the last bar in each run.
+        # The volume is the average of the run, so it stays within candlestickRect() and the volume y-range.
+        end = self.count() if end is None else min(end, self.count())
+        if bucket == 1:
+            return self.plotTimes[first:end], self.bars[:, first:end], np.arange(first, end)
+
+        starts = np.arange(first, end, bucket)
+        last = np.minimum(starts + bucket, end) - 1
+        bars = np.vstack([
+            self.open[starts],
+            np.maximum.reduceat(self.high[:end], starts),
+            np.minimum.reduceat(self.low[:end], starts),
+            self.close[last],
+            np.add.reduceat(self.volume[:end], starts) / (last - starts + 1)])
+        t = (self.plotTimes[starts] + self.plotTimes[last]) / 2.
+        return t, bars, last
+
+    def candlestickColumns(self, isVolume):
+        return self.barsBuffer[[VOLUME] if isVolume else slice(OPEN, CLOSE+1), :self.size]
+
+    def candlestickRect(self, isVolume):
+        # The area covered by all the candlesticks, without having to draw them.
+        # The y-range is kept, and onTailChange() only looks at the changed bars.
+        w = self.timeInterval / 3.
+        if isVolume not in self.candlestickRanges:
+            columns = self.candlestickColumns(isVolume)
+            self.candlestickRanges[isVolume] = (0. if isVolume else columns.min()), columns.max()
+        y1, y2 = self.candlestickRanges[isVolume]
+        t1, t2 = self.plotTimes[0] - w, self.plotTimes[-1] + w
+        return QtCore.QRectF(t1, y1, t2 - t1, y2 - y1)
+
     def getTA(self, ta):
+        self.calcIndicatorsMakePlots([ta])
         ret = self.__dict__['ta' + ta]
         return wrapList(ret)
 
     def chartCacheKey(self, responseIdx=0):
         return ['charts', self.exchange.name, self.symbolKey, self.timeframe, str(responseIdx)]
+    def seriesCacheKey(self):
+        return self.chartCacheKey()[:-1] + ['series']
 
-    def downloadAndParse(self, getOrders=False):
+    def downloadAndParse(self, getOrders=False, fromCache=False, incremental=True):
         responses = []
 
-        isRecent = False
-        if ChartData.cacheSeconds:
+        isRecent = fromCache# Only use the cache
+        if ChartData.cacheSeconds and not isRecent:
             chartKey = self.chartCacheKey(0)
             cached = gCache.get(chartKey)
             isRecent = cached and (now() - cached.time).seconds < ChartData.cacheSeconds
@@ -506,10 +1025,12 @@ class ChartData(pd.DataFrame):
             else:
                 cached = gCache.get(chartKey)
                 if not cached:
-                    print 'FAILED request and item not found in cache'
+                    if not fromCache:
+                        print 'FAILED request and item not found in cache'
                     return True
                 response = cached.value
 
+            response = getattr(response, 'content', response)# Websocket and older cached responses are just the content
             try: response = json.loads(response)
             except: pass# Yahoo uses CSV not json
 
@@ -518,24 +1039,75 @@ class ChartData(pd.DataFrame):
 
         auth = None #requests.auth.HTTPBasicAuth('rpcuser', 'rpcpass')
 
+        def fetch(urlDict, responseIdx):
+            # Non-socket requests
+            url = urlDict['url']
+            headers = {'Accept-Encoding': 'gzip, deflate'}
+            headers.update(urlDict.get('headers', {}))
+
+            # Ask the server if the cached response has changed. Most urls include the current time,
+            # so the ETag is sent whatever the url as it identifies the content itself.
+            # Last-Modified only says when the content at that url last changed.
+            cached = gCache.get(self.chartCacheKey(responseIdx))
+            cached = cached and cached.value
+            if not hasattr(cached, 'etag'):
+                cached = None# Websocket or older cached response, without validators
+            elif cached.etag:
+                headers['If-None-Match'] = cached.etag
+            elif cached.lastModified and cached.url == url:
+                headers['If-Modified-Since'] = cached.lastModified
+            else:
+                cached = None
+
+            print url
+            exchange = self.exchange
+            try:
+                with requestLimiter(exchange.name, exchange.maxConcurrentRequests, exchange.requestsPerSecond):
+                    response = httpSession(exchange.name).get(url, headers=headers, auth=auth)
+            except:
+                return None
+            if response.status_code == 304 and cached:
+                unchanged.append(responseIdx)
+                return cached# Not modified, so saving it again just marks it as recent
+            if not response.ok:
+                return None
+            return Struct(url=url, content=response.content,
+                          etag=response.headers.get('ETag'), lastModified=response.headers.get('Last-Modified'))
+
+        # Exchanges that can download from a given time only send the bars after the cached ones.
+        cachedSeries = None
+        self.downloadSince = None
+        incremental &= self.exchange.incrementalDownload
+        if incremental:
+            windowStart = timestamp(now() - dt.timedelta(days=self.exchange.windowDays(self.timeframe)))
+            cachedSeries = gCache.get(self.seriesCacheKey())
+            cachedSeries = cachedSeries and cachedSeries.value
+            if cachedSeries and len(cachedSeries.times):
+                self.downloadSince = cachedSeries.times[-min(DELTA_OVERLAP_BARS, len(cachedSeries.times))]
+
+        # Independent requests are all sent at once, then their responses are saved in order.
+        # Websocket posts can depend on earlier responses, so they are sent in turn.
         dataUrls = self.exchange.dataUrls(self, getOrders)
-        for urlDict in dataUrls:
+        fetches = {}
+        unchanged = []# Response indexes the server said were not modified
+        if not isRecent:
+            pool = threadPool('requests')
+            responseIdx = 0# Websocket urls have a response for each post
+            for i, urlDict in enumerate(dataUrls):
+                post = urlDict.get('post')
+                if not post:
+                    fetches[i] = pool.apply_async(fetch, (urlDict, responseIdx))
+                responseIdx += len(post) if post else 1
+
+        for i, urlDict in enumerate(dataUrls):
             url = urlDict['url']
             post = urlDict.get('post')
             if post:
                 # If there are multiple things to post, use websocket
-                # websocket doesnt pickup proxy settings from environment, like requests does.
-                options = {}
-                HTTP_PROXY = os.environ.get('HTTP_PROXY')
-                if HTTP_PROXY:
-                    from urlparse import urlparse
-                    p = urlparse(HTTP_PROXY)
-                    options.update(http_proxy_host=p.netloc.split(':')[0], http_proxy_port=p.port)
-
                 ws = None
                 if not isRecent:
                     print url
-                    try: ws = websocket.create_connection(url, **options)
+                    try: ws = websocket.create_connection(url, **websocketOptions())
                     except: pass
 
                 for p in post:
@@ -550,26 +1122,78 @@ class ChartData(pd.DataFrame):
                 if ws:
                     ws.close()
             else:
-                # Non-socket requests
-                response = None
-                if not isRecent:
-                    headers = {}
-                    headers.update(urlDict.get('headers', {}))
-                    print url
-                    try:
-                        if post:
-                            print post
-                            response = requests.post(url, json=post, headers=headers, auth=auth)
-                        else:
-                            response = requests.get(url, headers=headers)
-                    except:
-                        pass
-                    if response and response.ok:
-                        response = response.content
-
+                response = fetches[i].get() if i in fetches else None
                 responseErrors |= saveResponse(response)
 
         if responseErrors:
             return
 
+        if unchanged and len(unchanged) == len(dataUrls) and not getOrders:
+            # Nothing has changed since the bars were last parsed and saved, so just read them back
+            series = gCache.get(self.seriesCacheKey())
+            if series:
+                self.setColumns(series.value.times, series.value.bars)
+                self.onDataChange()
+                return
+
         self.exchange.parseData(self, responses)
+
+        # Merging into the saved bars and saving them back is one at a time, as another download
+        # of the series may have saved since it started. The downloads themselves aren't held up.
+        redownload = False
+        with perProcess(gSeriesLocks, tuple(self.seriesCacheKey()), threading.Lock):
+            if incremental:
+                cachedSeries = gCache.get(self.seriesCacheKey())
+                cachedSeries = cachedSeries and cachedSeries.value
+                if not self.mergeCachedSeries(cachedSeries, windowStart):
+                    redownload = self.downloadSince > windowStart and not isRecent
+                    if not redownload:
+                        print 'Gap after the cached bars of %s, so they are dropped' % self.symbolKey
+
+            if self.count() and not isRecent and not redownload:
+                gCache.set(self.seriesCacheKey(), Struct(times=self.times.copy(), bars=self.bars.copy()))
+
+        if redownload:
+            print 'Gap after the cached bars of %s, so downloading them all' % self.symbolKey
+            self.orderwall = []
+            self.downloadAndParse(getOrders, fromCache, False)
+
+STREAM_RETRY_SECONDS = 5
+class StreamThread(QtCore.QThread):
+    # Keeps a websocket subscription to the exchange open, collecting the trades it sends until stopped.
+    # ChartData must only change on the GUI thread, so that takes them with takeTrades().
+    def __init__(self, market):
+        super(StreamThread, self).__init__()
+        self.market = market
+        self.trades = []
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def takeTrades(self):
+        with self.lock:
+            trades, self.trades = self.trades, []
+        return trades
+
+    def run(self):
+        exchange = self.market.exchange
+        while not self.stopEvent.is_set():
+            try:
+                # Short timeout so stop() is noticed
+                ws = websocket.create_connection(exchange.streamUrl, timeout=1, **websocketOptions())
+                try:
+                    ws.send(json.dumps(exchange.streamSubscribe(self.market)))
+                    while not self.stopEvent.is_set():
+                        try: message = ws.recv()
+                        except websocket.WebSocketTimeoutException: continue
+                        trades = exchange.parseStreamMessage(self.market, json.loads(message))
+                        if trades:
+                            with self.lock:
+                                self.trades += trades
+                finally:
+                    ws.close()
+            except Exception as e:
+                print 'Stream disconnected:', e
+                self.stopEvent.wait(STREAM_RETRY_SECONDS)
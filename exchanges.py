@@ -1,6 +1,6 @@
 import numpy as np, datetime as dt
 import sys, inspect
-import requests, json, urllib
+import json, urllib
 from utils import *
 import ig
 
@@ -9,20 +9,21 @@ def parseOrderbook(self, data, response):
     for bidAsk in range(2):
 
         all_entries = response[['bids', 'asks'][bidAsk]]
+        entries = np.array(all_entries, dtype=float).reshape(len(all_entries), -1) if all_entries else np.zeros((0, 2))
 
-        prices = []
-        amounts = [0]
-        accumAmount = 0
-        for entry in all_entries:
+        prices = entries[:, 0]
+        amounts = np.cumsum(entries[:, 1])
 
-            price = float(entry[0])
-            amount = entry[1]
+        tickSize = self.orderbookTickSize
+        if tickSize and len(prices):
+            # Merge the levels into buckets of tickSize, rounding away from the spread.
+            # Prices are sorted so each bucket is a run, and its depth is the cumulative amount at the end of it.
+            rounding = np.floor if bidAsk == 0 else np.ceil
+            prices = rounding(np.round(prices / tickSize, 9)) * tickSize
+            lastInBucket = np.append(prices[1:] != prices[:-1], True)
+            prices, amounts = prices[lastInBucket], amounts[lastInBucket]
 
-            accumAmount += amount
-            prices.append(price)
-            amounts.append(accumAmount)
-
-        data.orderwall.append([prices, amounts])
+        data.orderwall.append([prices, np.append(0., amounts)])# amounts starts with an extra 0
 
 EXCHANGES = []
 class Exchange(object):
@@ -42,14 +43,36 @@ class Exchange(object):
             # so fill with minute data in the meantime.
             appendMinuteData=False,
             symbols=symbols,
-            defaultTimeframe='d')
+            defaultTimeframe='d',
+            # Price bucket size to merge orderbook levels into, None to show every level
+            orderbookTickSize=None,
+            # Limits on data downloads, to keep under the exchange's published rate limits
+            maxConcurrentRequests=4,
+            requestsPerSecond=None,
+            # dataUrls can start from data.downloadSince, so only new bars are downloaded
+            incrementalDownload=False,
+            # Websocket sending live trades, see streamSubscribe() and parseStreamMessage()
+            streamUrl=None)
 
     def findSymbol(self, partialName):
         partialName = partialName.upper()
         # Search for a symbol by its partial name
         return next((k for k in sorted(self.symbols) if partialName.upper() in k.upper()), partialName)
 
+    def windowDays(self, timeframe):# How far back a full download goes, for incrementalDownload
+        return self.intervals[timeframe]
+
+    def downloadStart(self, data):
+        # Start after the cached bars, unless they're older than a full download.
+        start = now() - dt.timedelta(days=self.windowDays(data.timeframe))
+        since = data.downloadSince
+        return max(start, fromtimestamp(since)) if since else start
+
+    def streamSubscribe(self, market): pass# Message sent to streamUrl to start receiving trades
+    def parseStreamMessage(self, market, message): return []# List of [time, price, amount]
+
     def onChartLoad(self, cg): pass
+    def onDownloadStart(self): pass# Called on the GUI thread before downloading in the background
     def onSearchOpen(self): pass
     def onSearchString(self, searchString): pass
 
@@ -139,7 +162,7 @@ class _2(Exchange):
     }
 
 def getPoloniexMarkets():
-    response = requests.get('https://poloniex.com/public?command=return24hVolume')
+    response = httpSession(findExchange('Poloniex').name).get('https://poloniex.com/public?command=return24hVolume')
     j = json.loads(response.content)
     marketVolume = {}
     for key, value in j.iteritems():
@@ -159,16 +182,21 @@ def savePoloniexMarkets():
 
 class _3(Exchange):
     name = 'Poloniex'
+    requestsPerSecond = 6
+    incrementalDownload = True
     def __init__(self):
         Exchange.__init__(self)
 
     # https://poloniex.com/support/api
     # Valid intervals are 300, 900, 1800, 7200, 14400, and 86400
 
+    def currencyPair(self, symbolKey):
+        return (lambda sp: sp[1] + '_' + sp[0])(symbolKey.split('/'))
+
     def dataUrls(self, data, getOrders):
-        symbol = (lambda sp: sp[1] + '_' + sp[0])(data.symbolKey.split('/'))
+        symbol = self.currencyPair(data.symbolKey)
         return [{'url': 'https://poloniex.com/public?command=returnChartData&currencyPair=' + symbol +\
-        '&start=' + str(timestamp(now() - dt.timedelta(days=self.intervals[data.timeframe]))) + '&end=9999999999&' +\
+        '&start=' + str(timestamp(self.downloadStart(data))) + '&end=9999999999&' +\
         'period=%i' % intervalSeconds(data.timeframe)
         }] +\
         ([{'url': 'https://poloniex.com/public?command=returnOrderBook&currencyPair=%s&depth=1000'
@@ -193,6 +221,18 @@ class _3(Exchange):
         if len(responses) > 1:
             parseOrderbook(self, data, responses[1])
 
+    # Live trades from the push api
+    streamUrl = 'wss://api2.poloniex.com'
+    def streamSubscribe(self, market):
+        return {'command': 'subscribe', 'channel': self.currencyPair(market.symbolKey)}
+
+    def parseStreamMessage(self, market, message):
+        # [channel, sequence, [['i', ...], ['o', ...], ['t', tradeId, isBuy, rate, amount, time], ...]]
+        if len(message) < 3:
+            return []# Heartbeat or subscription acknowledgement
+        # Volume in base, like the chart data
+        return [[float(u[5]), float(u[3]), float(u[3]) * float(u[4])] for u in message[2] if u[0] == 't']
+
     intervals = {
         '1d': 1000,
         '4h': 100,
@@ -237,6 +277,7 @@ class _6(ExchangeWithSearch):
     name = '&Yahoo Finance'
     filterGaps = True
     appendMinuteData = True
+    incrementalDownload = True
     def __init__(self):
         ExchangeWithSearch.__init__(self)
 
@@ -244,7 +285,7 @@ class _6(ExchangeWithSearch):
 
         url = 'https://beta.finance.yahoo.com/_finance_doubledown/api/resource/searchassist;gossipConfig={"isJSONP":true,"queryKey":"query","resultAccessor":"ResultSet.Result","suggestionTitleAccessor":"symbol","suggestionMeta":["symbol"],"url":{"protocol":"https","host":"s.yimg.com","path":"/xb/v6/finance/autocomplete","query":{"appid":"yahoo.com","nresults":10,"output":"yjsonp","region":"US","lang":"en-US"}}};searchTerm=' \
             + searchString + '?bkt=DD_Test_4&device=desktop&intl=us&lang=en-US&partner=none&region=US&site=finance&tz=America/Los_Angeles&ver=0.4.528'
-        response = requests.get(url)
+        response = httpSession(self.name).get(url)
 
         j = json.loads(response.content)
         j = j.get('items', [])
@@ -257,7 +298,7 @@ class _6(ExchangeWithSearch):
         # Url used by Yahoo's website charts.
         return [{'url': 'https://finance-yql.media.yahoo.com/v7/finance/chart/' + data.symbolKey + \
         '?period2=' + str(timestamp(now())) + \
-        '&period1=' + str(timestamp(now() - dt.timedelta(days=self.intervals[data.timeframe]))) + \
+        '&period1=' + str(timestamp(self.downloadStart(data))) + \
         '&interval=' + data.timeframe.upper() + ('k' if data.timeframe == '1w' else '') + \
         '&indicators=quote&includeTimestamps=true&includePrePost=true&events=div|split|earn&corsDomain=finance.yahoo.com'}]
 
@@ -305,13 +346,14 @@ class _7(ExchangeWithSearch):
     name = '&Google Finance'
     filterGaps = True
     appendMinuteData = True
+    incrementalDownload = True
     defaultTimeframe = 'h'# Daily doesnt work for some low market cap stocks
     def __init__(self):
         ExchangeWithSearch.__init__(self)
 
     def onSearchString(self, searchString):
         url = 'https://www.google.com/finance/match?matchtype=matchall&ei=I8lhVunvB5GQUPehn-gP&q=' + searchString
-        response = requests.get(url)
+        response = httpSession(self.name).get(url)
 
         j = json.loads(response.content)
         j = j.get('matches', [])
@@ -329,12 +371,23 @@ class _7(ExchangeWithSearch):
         sp = cg.data.symbolKey.split(':')
         addStockLinks(cg, sp[1], sp[0])
 
+    def windowDays(self, timeframe):
+        period = self.intervals[timeframe]
+        return int(period[:-1]) * dict(Y=365, d=1)[period[-1]]
+
     def dataUrls(self, data, getOrders):
+        # The period is counted back from now, so ask for enough days to reach the cached bars.
+        period = self.intervals[data.timeframe]
+        days = self.windowDays(data.timeframe)
+        start = self.downloadStart(data)
+        if start > now() - dt.timedelta(days=days):
+            period = '%id' % ((now() - start).days + 1)
+
         # Url used by Google's flash charts.
         return [{'url': 'https://www.google.co.uk/finance/getprices?q=' + data.symbolKey.split(':')[1] + \
         '&x=' + data.symbolKey.split(':')[0] + \
         '&i=' + str(intervalSeconds(data.timeframe)) + \
-        '&p=' + self.intervals[data.timeframe] + '&f=d,c,v,o,h,l&df=cpct&auto=1' + \
+        '&p=' + period + '&f=d,c,v,o,h,l&df=cpct&auto=1' + \
         '&ts=' + str(timestamp(now()))}]
 
     def parseData(self, data, responses):
@@ -378,6 +431,9 @@ IGINDEX_DATETIME_FORMAT = '%Y/%m/%d/%H/%M/%S'
 class _8(ExchangeWithSearch):
     name = '&IG'
     filterGaps = True
+    incrementalDownload = True
+    maxConcurrentRequests = 2
+    requestsPerSecond = 1
     positions = {}
     def __init__(self):
         ExchangeWithSearch.__init__(self)
@@ -397,13 +453,17 @@ class _8(ExchangeWithSearch):
         return ret
 
     onSearchOpen = lambda self: ig.getHeaders()# Display the login dialog if neccessary
+    onDownloadStart = onSearchOpen
     def onChartLoad(exchange, cg):
         cg.position = exchange.positions.get(cg.data.symbolKey)
 
+    def windowDays(self, timeframe):
+        return self.intervals[timeframe][1]
+
     def dataUrls(self, data, getOrders):
         return [
             {'url': 'https://api.ig.com/chart/snapshot/' + data.symbolKey + '/' + self.intervals[data.timeframe][0] +\
-            '/batch/start/' + (now() - dt.timedelta(days=self.intervals[data.timeframe][1])).strftime(IGINDEX_DATETIME_FORMAT) +\
+            '/batch/start/' + self.downloadStart(data).strftime(IGINDEX_DATETIME_FORMAT) +\
             '/0/end/' + now().strftime(IGINDEX_DATETIME_FORMAT) + '/999' +\
             '?format=json&siteId=igi&locale=en_GB',
             'headers': ig.getHeaders()}
@@ -1,5 +1,5 @@
 from pyqtgraph import QtGui
-import requests, json, time, os
+import json, time, os, threading
 from utils import *
 import exchanges, watchlists
 
@@ -30,7 +30,7 @@ class Login(QtGui.QDialog):
             'identifier': str(self.textName.text()),
             'password': str(self.textPass.text())
         }
-        response = requests.post(url, json=body, headers=headers)
+        response = httpSession(exchanges.findExchange('IG').name).post(url, json=body, headers=headers)
 
         if response.ok:
             self.headers = response.headers
@@ -39,50 +39,59 @@ class Login(QtGui.QDialog):
             QtGui.QMessageBox.warning(
                 self, 'Error', 'Failed to login: ' + str(response))
 
-def getHeaders(getNewTokens=False):
-    NEEDED_API_KEY = 'X-IG-API-KEY'
-    NEEDED_TOKENS = ['X-SECURITY-TOKEN', 'CST']# Also need the api
+loginLock = threading.RLock()# getOpenPositions() calls back into getHeaders()
+def getHeaders(getNewTokens=False, invalidHeaders=None):
+    # Watchlist threads can all find they need to login at once, so only one does it.
+    with loginLock:
+        NEEDED_API_KEY = 'X-IG-API-KEY'
+        NEEDED_TOKENS = ['X-SECURITY-TOKEN', 'CST']# Also need the api
 
-    headersFile = CACHE_DIR + '/ig_headers.json'
+        headersFile = CACHE_DIR + '/ig_headers.json'
 
-    ig = exchanges.findExchange('IG')
+        ig = exchanges.findExchange('IG')
 
-    ig.headers = getattr(ig, 'headers', {})
-    if not ig.headers:
-        ig.headers = json.loads(open(headersFile).read())
-    apiKey = ig.headers.get(NEEDED_API_KEY)
+        ig.headers = getattr(ig, 'headers', {})
+        if not ig.headers:
+            ig.headers = json.loads(open(headersFile).read())
+        apiKey = ig.headers.get(NEEDED_API_KEY)
 
-    if not apiKey:
-        print('ERROR: Could not find ' + NEEDED_API_KEY)
-        raise BaseException
+        if not apiKey:
+            print('ERROR: Could not find ' + NEEDED_API_KEY)
+            raise BaseException
 
-    try:
-        if getNewTokens or any(not ig.headers.get(k) for k in NEEDED_TOKENS):
-            # We havent saved some of the tokens, so login to IG and get them
-            login = Login(apiKey)
-            if login.exec_() != QtGui.QDialog.Accepted:
-                os._exit(1) # directly exit without throwing an exception
+        if invalidHeaders and any(ig.headers.get(k) != invalidHeaders.get(k) for k in NEEDED_TOKENS):
+            getNewTokens = False# Another thread logged in while this one waited
 
-            for k in NEEDED_TOKENS:
-                ig.headers[k] = login.headers[k]
+        try:
+            if getNewTokens or any(not ig.headers.get(k) for k in NEEDED_TOKENS):
+                # We havent saved some of the tokens, so login to IG and get them
+                if not isinstance(threading.current_thread(), threading._MainThread):
+                    return ig.headers# The dialog can only be shown on the main thread, see onDownloadStart()
+                login = Login(apiKey)
+                if login.exec_() != QtGui.QDialog.Accepted:
+                    os._exit(1) # directly exit without throwing an exception
+
+                for k in NEEDED_TOKENS:
+                    ig.headers[k] = login.headers[k]
 
-            print('New login header: ' + str(ig.headers))
+                print('New login header: ' + str(ig.headers))
 
-            if login.saveLogin.isChecked():
-                json.dump(ig.headers, open(headersFile, 'w'))
+                if login.saveLogin.isChecked():
+                    json.dump(ig.headers, open(headersFile, 'w'))
 
-        if not hasattr(ig, 'positions'):
-            getOpenPositions()# Will raise if offline
-    except:
-        pass# Allow viewing charts offline if possible
+            if not hasattr(ig, 'positions'):
+                getOpenPositions()# Will raise if offline
+        except:
+            pass# Allow viewing charts offline if possible
 
-    return ig.headers
+        return ig.headers
 
 def callAPI(url):
     getNewTokens = False
+    headers = None
     while True:
-        headers = getHeaders(getNewTokens)
-        response = requests.get(IG_URL + url, headers=headers)
+        headers = dict(getHeaders(getNewTokens, headers))
+        response = httpSession(exchanges.findExchange('IG').name).get(IG_URL + url, headers=headers)
         try:
             content = json.loads(response.content)
         except:
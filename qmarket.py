@@ -3,7 +3,7 @@
 import pyqtgraph as pg
 from pyqtgraph import QtCore, QtGui
 Qt = QtCore.Qt
-import os, sys, math, types, datetime as dt
+import os, sys, math, types, traceback, datetime as dt
 import exchanges, symbolfinder, watchlists
 from utils import *
 from chartdata import *
@@ -27,7 +27,23 @@ SHOW_OPTIONS = [
     ('Pulse', '&Pulse'),
     ('TrendBars', '&Trend Bars'),
     ('LocateBox', '&Locate Box'),
+    ('Stream', 'Live Strea&m'),
 ]
+STREAM_REDRAW_MS = 250 # Live trades are added and drawn in batches this often
+
+def localTimestamps(naive):
+    # Wall-clock datetime64s to epoch seconds, each with its own daylight saving offset.
+    return np.array([timestamp(d) for d in naive.astype('datetime64[s]').astype(dt.datetime)], dtype=float)
+
+def calendarTicks(unit, first, last):
+    # The start of every year, month, week, day or hour between the wall-clock times.
+    if unit == 'week':
+        # Weeks start on the 1st, 8th, 15th, 22nd and 29th of each month
+        days = calendarTicks('day', dt.datetime(first.year, first.month, 1), last)
+        dayOfMonth = (days - days.astype('datetime64[M]')).astype(int)
+        return days[dayOfMonth % 7 == 0]
+    npUnit = 'datetime64[%s]' % dict(year='Y', month='M', day='D', hour='h')[unit]
+    return np.arange(np.datetime64(first).astype(npUnit), np.datetime64(last).astype(npUnit) + 1)
 
 class DateAxis(pg.AxisItem):
     SPACING_HOUR =  3600
@@ -37,6 +53,17 @@ class DateAxis(pg.AxisItem):
     SPACING_YEAR =  3600*24*30*12
     SPACING_YEARS = 3600*24*30*24
 
+    # Calendar tick times are worked out a chunk at a time and shared by all the axes.
+    # Each chunk is longer than the longest gap between ticks.
+    CHUNK_SECONDS = dict(
+        year=SPACING_YEAR * 10,
+        month=SPACING_YEAR * 2,
+        week=SPACING_YEAR,
+        day=SPACING_YEAR,
+        hour=SPACING_WEEK)
+    chunkCache = {}
+    tickStringCache = {}
+
     def tickStrings(self, values, scale, spacing):
         strns = []
         rng = spacing
@@ -61,69 +88,80 @@ class DateAxis(pg.AxisItem):
 
         values = self.allTicks[spacing]
         for x in values:
-            try:
-                strns.append(fromtimestamp(x).strftime(format))
-            except ValueError:  ## Can't handle dates before 1970
-                strns.append('')
+            key = (x, format)
+            if key not in self.tickStringCache:
+                try:
+                    self.tickStringCache[key] = fromtimestamp(x).strftime(format)
+                except ValueError:  ## Can't handle dates before 1970
+                    self.tickStringCache[key] = ''
+            strns.append(self.tickStringCache[key])
 
         return strns
 
+    def calendarTicksChunk(self, unit, chunk):
+        key = (unit, chunk)
+        if key not in self.chunkCache:
+            seconds = self.CHUNK_SECONDS[unit]
+            start, end = chunk * seconds, (chunk + 1) * seconds
+            ticks = localTimestamps(calendarTicks(unit, fromtimestamp(start), fromtimestamp(end)))
+            self.chunkCache[key] = ticks[(ticks >= start) & (ticks < end)]
+        return self.chunkCache[key]
+
+    def calendarTicksInView(self, unit, minVal, maxVal):
+        # From the last tick at or before minVal, as that can still land on a bar in view.
+        seconds = self.CHUNK_SECONDS[unit]
+        chunks = range(int(minVal // seconds) - 1, int(maxVal // seconds) + 1)
+        ticks = np.concatenate([self.calendarTicksChunk(unit, chunk) for chunk in chunks])
+        first = max(ticks.searchsorted(minVal, 'right') - 1, 0)
+        return ticks[first:ticks.searchsorted(maxVal, 'right')]
+
     def tickValues(self, minVal, maxVal, size):
         data = self.cg.data
         if not data.count():
             return []
 
         minVal = max(minVal, data.times[0])
-        maxVal = min(maxVal, data.times.iloc[-1])
+        maxVal = min(maxVal, data.times[-1])
 
-        tmin = fromtimestamp(minVal)
-        tmax = fromtimestamp(maxVal)
+        # Redraws without panning or new bars get the same ticks.
+        key = (id(data), data.count(), data.times[-1], minVal, maxVal)
+        if getattr(self, 'ticksKey', None) == key:
+            return self.ticks
+        self.ticksKey = key
 
         allTicks = []
-        def addTicks(spacing, currdt, nexttime):
-            ticks = []
-            while currdt <= tmax:
-                idx = data.clampIndex(data.findTimeIndex(timestamp(currdt)))
-                if not any([idx in prevTicks[1] for prevTicks in allTicks]):
-                    ticks.append(idx)
-                currdt = nexttime(currdt)
-            allTicks.append((spacing, ticks))
+        usedIdx = set()
+        def addTicks(spacing, unit):
+            idx = data.times.searchsorted(self.calendarTicksInView(unit, minVal, maxVal))
+            idx = np.unique(np.minimum(idx, data.count() - 1))
+            # Only keep the bars not already ticked at a larger spacing
+            idx = [i for i in idx if i not in usedIdx]
+            usedIdx.update(idx)
+            allTicks.append((spacing, idx))
 
         rng = maxVal - minVal
         if rng > self.SPACING_MONTH * 6:
-            addTicks(self.SPACING_YEAR,
-                     dt.datetime(tmin.year, 1, 1),
-                     lambda t: dt.datetime(t.year + 1, 1, 1))
+            addTicks(self.SPACING_YEAR, 'year')
         if rng < self.SPACING_YEAR * 2:
-            addTicks(self.SPACING_MONTH,
-                     dt.datetime(tmin.year, tmin.month, 1),
-                     lambda t: dt.datetime(t.year + 1, 1, 1) if t.month == 12 \
-                               else dt.datetime(t.year, t.month + 1, 1))
+            addTicks(self.SPACING_MONTH, 'month')
             if rng < self.SPACING_MONTH * 1:
-                addTicks(self.SPACING_DAY,
-                         dt.datetime(tmin.year, tmin.month, tmin.day),
-                         lambda t: t + dt.timedelta(days=1))
+                addTicks(self.SPACING_DAY, 'day')
                 if rng < self.SPACING_DAY * 3:
-                    addTicks(self.SPACING_HOUR,
-                             dt.datetime(tmin.year, tmin.month, tmin.day, tmin.hour, 0, 0),
-                             lambda t: t + dt.timedelta(hours=1))
+                    addTicks(self.SPACING_HOUR, 'hour')
             elif rng < self.SPACING_MONTH * 4:
                 # Show week beginnings
-                startingWeek = lambda t: dt.datetime(t.year, t.month, 7 * (int(math.ceil(t.day / 7.)) - 1) + 1)
-                addTicks(self.SPACING_DAY,
-                         startingWeek(tmin),
-                         lambda t: startingWeek(t + dt.timedelta(days=7)))
+                addTicks(self.SPACING_DAY, 'week')
 
         # Save before we modify for filter mode
         self.allTicks = {spacing:
-                        [data.times[idx] for idx in ticks]
-                        for spacing, ticks in allTicks}
+                        data.times[idx].tolist()
+                        for spacing, idx in allTicks}
 
-        allTicks = [(spacing,
-                    [data.plotTimes[idx] for idx in ticks])
-                    for spacing, ticks in allTicks]
+        self.ticks = [(spacing,
+                      data.plotTimes[idx].tolist())
+                      for spacing, idx in allTicks]
 
-        return allTicks
+        return self.ticks
 
 # Shortern the volume numbers to fit more labels along the orderbook x-axis.
 class SuffixVolumeAxis(pg.AxisItem):
@@ -151,20 +189,23 @@ def findYRange(vb, xRange, yColumns):
         idx = [data.findTimeIndex(x) for x in xRange]
 
     if idx[1] > idx[0]:
-        init = sys.float_info.max
-        y_min = init
-        y_max = -init
         idx = [data.clampIndex(i) for i in idx]
-        for column in yColumns:
-            column = column[idx[0]:idx[1]+1]
-            y_min = min(y_min, column.min())
-            y_max = max(y_max, column.max())
-
-        if abs(y_min) != init and abs(y_max) != init:
-            return y_min, y_max
+        return data.findRange(yColumns, idx[0], idx[1])
 
     return None
 
+def lastIndexInRange(prices, y_min, y_max):
+    # Prices are sorted, descending for bids and ascending for asks.
+    if len(prices) > 1 and prices[0] > prices[-1]:
+        ascending = prices[::-1]
+    else:
+        ascending = prices
+    first = ascending.searchsorted(y_min, 'left')
+    end = ascending.searchsorted(y_max, 'right')
+    if first >= end:
+        return None
+    return end - 1 if ascending is prices else len(prices) - 1 - first
+
 def findXRange(vb, yRange):
     if vb.cg.data is None:
         return None
@@ -179,12 +220,12 @@ def findXRange(vb, yRange):
         prices = data.orderwall[bidAsk][0]
         amounts = data.orderwall[bidAsk][1]
 
-        for i in xrange(int(len(prices)*0.9)):
-            price = prices[i]
-            if price >= y_min and price <= y_max:
-                amount = amounts[1 + i] # amounts starts with an extra 0
-                x_max = max(x_max, amount)
-                ret = [0, x_max * 1.2]
+        # The amounts are cumulative, so the furthest level in range has the largest.
+        i = lastIndexInRange(prices[:int(len(prices)*0.9)], y_min, y_max)
+        if i is not None:
+            amount = amounts[1 + i] # amounts starts with an extra 0
+            x_max = max(x_max, amount)
+            ret = [0, x_max * 1.2]
 
     return ret
 
@@ -293,7 +334,9 @@ class PricesViewBox(pg.ViewBox):
                 gSettings.setValue(showVar, value)
                 if value and showMember == 'Orderwall':
                     # Toggling the orderwall requires downloading the orderbook
-                    cg.downloadNewData()
+                    cg.downloadNewData(refresh=True)
+                elif showMember == 'Stream':
+                    sharedChartData.updateStream(cg.sharedKey)
                 else:
                     cg.reAddPlotItems()
 
@@ -303,7 +346,7 @@ class PricesViewBox(pg.ViewBox):
             addToggle(var, desc)
 
         addAction('&Refresh Chart', self.menu,
-            lambda: self.cg.downloadNewData(), insertBefore)
+            lambda: self.cg.downloadNewData(refresh=True), insertBefore)
 
         addSeperator()
 
@@ -342,9 +385,9 @@ class PricesViewBox(pg.ViewBox):
             xr = [rect.left(), rect.right()] if rect else viewRange[0]
 
             if data.isOHLC:
-                columns = [data.high, data.low]
+                columns = ['high', 'low']
             else:
-                columns = [data.close]
+                columns = ['close']
 
             yRange = findYRange(self, xr, columns) or viewRange[1]
 
@@ -383,22 +426,57 @@ class OrderbookViewBox(pg.ViewBox):
         pg.ViewBox.setRange(self, rect, xRange, yRange, padding, update, disableAutoRange)
 
 class CandlestickItem(pg.GraphicsObject):
-    def __init__(self, picture):
+    def __init__(self, data, isVolume, showTrendBars):
         pg.GraphicsObject.__init__(self)
-        self.picture = picture
+        self.setData(data, isVolume, showTrendBars)
+
+    def setData(self, data, isVolume, showTrendBars):
+        # The item stays in its ViewBox, only what it draws changes
+        self.prepareGeometryChange()
+        self.data = data
+        self.isVolume = isVolume
+        self.showTrendBars = showTrendBars
+        self.rect = data.candlestickRect(isVolume)
+        self.update()
+
+    def bucketSize(self):
+        # When zoomed out so bars share pixel columns, draw them combined.
+        # Rounded up to a power of two so the pictures get reused while zooming.
+        barsPerPixel = saveDiv(self.pixelWidth() or 0., self.data.timeInterval)
+        if barsPerPixel <= 1.:
+            return 1
+        return 2 ** int(math.ceil(math.log(barsPerPixel, 2)))
+
+    def visibleTiles(self, bucket):
+        # Tiles that are off-screen dont need drawing
+        rect = self.viewRect()
+        if rect is None:
+            return None
+        data = self.data
+        first, end = data.plotTimes.searchsorted([rect.left(), rect.right()])
+        tileBars = TILE_BARS * bucket
+        return range(max(first - 1, 0) // tileBars, min(end, data.count() - 1) // tileBars + 1)
 
     def paint(self, p, *args):
-        p.drawPicture(0, 0, self.picture)
+        bucket = self.bucketSize()
+        for picture in self.data.createCandlestick(self.isVolume, self.showTrendBars, bucket, self.visibleTiles(bucket)):
+            p.drawPicture(0, 0, picture)
 
     def boundingRect(self):
-        rect = QtCore.QRectF(self.picture.boundingRect())
-        return rect
+        return self.rect
+
+# Long lines only draw what is in view, as a min/max envelope per pixel when zoomed out.
+# pyqtgraph redoes it itself when the view range changes.
+LINE_DECIMATION = dict(clipToView=True, autoDownsample=True, downsampleMethod='peak')
 
 def legendItemName(legend, idx):
     return legend.items[idx][1].text
-def clearLegend(legend):
-    while legend.items:
-        legend.removeItem(legendItemName(legend, 0))
+def removeLegendTables(legend):
+    # Remove the OHLC table, which is not always the last item when indicators have been added since.
+    for i in reversed(range(len(legend.items))):
+        text = legendItemName(legend, i)
+        if text.find('<table>') != -1:
+            legend.removeItem(text)
 def zeroLayoutMargins(layout):
     layout.setSpacing(0)
     layout.setContentsMargins(0, 0, 0, 0)
@@ -407,6 +485,10 @@ class ChartGroup():
     def __init__(self, window):
         self.window = window
         self.locateGroup = None
+        self.legendKey = None
+        self.loadGeneration = 0
+        self.loadThreads = []
+        self.removed = False
         self.loadDefaultChartSettings()
 
         self.widget = pg.GraphicsLayoutWidget()
@@ -490,19 +572,48 @@ class ChartGroup():
         else:
             self.window.setChartAt(self.data, coord) # Display data again without re-downloading
 
-    def downloadNewData(self):
-        data = ChartData(self.market)# Blank data object
-        if self.market:# Check for empty chart
-            data.downloadAndParse(getOrders=self.showOrderwall)
+    def downloadNewData(self, refresh=False):
+        # Another chart may already be showing it, unless a fresh download was asked for
+        shared = self.market and sharedChartData.find(ChartData(self.market), self)
+        if shared and not refresh and (shared.orderwall or not self.showOrderwall):
+            self.assignData(shared)
+            return
 
-            if data.exchange.appendMinuteData and data.timeframe[1] in ['h', 'd']:
-                market = self.market.copy()
-                market.timeframe = 'm'
-                minuteDataToCopy = ChartData(market)
-                minuteDataToCopy.downloadAndParse()
-                data.appendMinuteData(minuteDataToCopy)
+        # Show what another chart has, or any cached data, straight away while the latest downloads in the background.
+        # It's not given to the other charts, as it's older than what they have.
+        self.assignData(shared or loadChartData(self.market, self.showOrderwall, fromCache=True), publish=False)
+        if not self.market:
+            return
+        self.market.exchange.onDownloadStart()
 
-        self.assignData(data)
+        market, getOrders, indicators = self.market.copy(), self.showOrderwall, self.shownIndicators()
+        class Thread(QtCore.QThread):
+            def run(self):
+                try:
+                    data = loadChartData(market, getOrders)
+                    data.calcIndicatorsMakePlots(indicators)
+                    self.data = data
+                except:
+                    traceback.print_exc()
+
+        thread = Thread()
+        thread.data = None
+        thread.generation = self.loadGeneration
+        self.loadThreads.append(thread)# Keep a reference until it has finished
+        thread.finished.connect(lambda: self.onDataLoaded(thread))
+        thread.start()
+
+    def onDataLoaded(self, thread):
+        self.loadThreads.remove(thread)
+        # Ignore it if the chart has been changed or removed since
+        if thread.generation == self.loadGeneration and not self.removed and thread.data is not None:
+            self.assignData(thread.data)
+
+    def remove(self):
+        # The chart or its window is going away, so any download still going is ignored
+        self.removed = True
+        self.loadGeneration += 1
+        sharedChartData.hide(self)
 
     def forceRecalcRanges(self):
         # Trigger all the y-ranges to be recalculated.
@@ -512,11 +623,17 @@ class ChartGroup():
         vb.setRange(xRange=[0, 1])
         vb.setRange(xRange=xRange)
 
-    def assignData(self, data):
-        data.calcIndicatorsMakePlots()
+    def shownIndicators(self):
+        return [var for var, desc in SHOW_OPTIONS if getattr(self, 'show' + var)] +\
+            (['Trend'] if self.showTrendBars else [])
+
+    def assignData(self, data, publish=True):
+        self.loadGeneration += 1# Any download still going is out of date
+        data.calcIndicatorsMakePlots(self.shownIndicators())
         self.data = data
         self.reAddPlotItems()
         self.forceRecalcRanges()
+        sharedChartData.show(self, data, publish)
 
     def openSearchMenu(self, exchange):
         def onChooseSearchResult(result):
@@ -550,7 +667,7 @@ class ChartGroup():
         self.mainPlot().vb.scene().removeItem(self.locateGroup)
         self.locateGroup = None
 
-    def setLinesAndFillLegend(self, globalMousePos, mainPlotViewPos):
+    def setLinesAndFillLegend(self, globalMousePos, mainPlotViewPos, barIndexes):
         mousePos = self.widget.mapFromGlobal(globalMousePos)
         mainPlot = self.mainPlot()
 
@@ -558,16 +675,19 @@ class ChartGroup():
         data = self.data
         time = mainPlotViewPos.x()
         if data.count():
+            # Linked charts showing the same data share the index.
+            key = (id(data), time)
+            if key not in barIndexes:
+                # Add on half an interval so we transition at the bar edges and not in the middle.
+                #time += data.timeInterval/2
+                # Find data to put in OHLC legend.
+                if data.exchange.filterGaps:
+                    idx = data.unfilterIndex(time)
+                else:
+                    idx = data.findTimeIndex(time) - 1
 
-            # Add on half an interval so we transition at the bar edges and not in the middle.
-            #time += data.timeInterval/2
-            # Find data to put in OHLC legend.
-            if data.exchange.filterGaps:
-                idx = data.unfilterIndex(time)
-            else:
-                idx = data.findTimeIndex(time) - 1
-
-            idx = data.clampIndex(idx)# Make it always in range
+                barIndexes[key] = data.clampIndex(idx)# Make it always in range
+            idx = barIndexes[key]
             idxInRange = idx >= 0 and idx < data.count()
 
         datetimeStr=None
@@ -577,6 +697,10 @@ class ChartGroup():
             formatDatetime = lambda datetime: fromtimestamp(datetime).strftime('%d-%m-%Y %H:%M:%S')
             datetimeStr = formatDatetime(data.times[idx])
 
+        # The legend only needs changing when moving to another bar, or the bar itself changes.
+        legendKey = (id(data), idx, data.getOHLCV(idx)) if idxInRange else None
+        if legendKey and legendKey != self.legendKey:
+            self.legendKey = legendKey
             nv = lambda name, strValue: '<tr><td>' + (name + ':').ljust(8) + '</td><td><b>' + strValue.ljust(8) + '</b></td></tr>'
             formatPrice = lambda price: '{:,.8f}'.format(price).rstrip('0').ljust(10)
             if data.isOHLC:
@@ -591,10 +715,7 @@ class ChartGroup():
             label = datetimeStr + '<table>' + label + '</table>'
 
             legend = mainPlot.legend
-            if legend.items:
-                lastText = legendItemName(legend, -1)
-                if lastText.find('<table>') != -1:
-                    legend.removeItem(lastText)
+            removeLegendTables(legend)
             legend.addItem(Struct(opts={'pen':(0,0,0,0)}), label)
             legend.setGeometry(0, 0, legend.width()-25, legend.height())# Undo ever-increasing width in LegendItem.updateSize()
 
@@ -624,11 +745,18 @@ class ChartGroup():
                 plt.createLine('lineH', plotY, PEN_CROSSHAIR, lineLabel=True, visible=overThis[ROW], angle=0, labelPos=vbRect.right(), axisPlot=axisPlot)
                 plt.createLine('lineV', plotX, PEN_CROSSHAIR, lineLabel, visible=True, angle=90, labelPos=vbRect.top())
 
-    def createPlot(self, plotType):
+    def createPlot(self, plotType, key=None):
         typeList = self.plotTypes[plotType]
-        if typeList.usedCount < len(typeList.plots):
-            ret = typeList.plots[typeList.usedCount]
+        unused = typeList.plots[typeList.usedCount:]
+        # Prefer the plot that showed the same thing last time, so its items can be kept,
+        # and dont take one from an indicator that is still shown.
+        ret = next((plt for plt in unused if plt.key == key), None) or \
+              next((plt for plt in unused if not getattr(self, 'show%s' % plt.key, False)), None)
+        if ret:
+            typeList.plots.remove(ret)
+            typeList.plots.insert(typeList.usedCount, ret)
             typeList.usedCount += 1
+            ret.key = key
             return ret
 
         vb = { # Viewboxes will be replaced by PlotItems
@@ -681,6 +809,9 @@ class ChartGroup():
         if plotType in [PLOT_VOLUME, PLOT_EXTRA_TA]:
             plt.setXLink(self.mainPlot())
 
+        plt.key = key
+        plt.itemGroups = {}
+        plt.itemUpdaters = {}
         plt.lineItems = {}
         def createLine(plt, name, linePos, pen, lineLabel=None, visible=True, angle=0, labelPos=None, **kwds):
             item = plt.lineItems.get(name)
@@ -728,18 +859,64 @@ class ChartGroup():
 
         plt.createLine = types.MethodType(createLine, plt)
 
-        typeList.plots.append(plt)
-        typeList.usedCount = len(typeList.plots)
+        typeList.plots.insert(typeList.usedCount, plt)
+        typeList.usedCount += 1
         return plt
 
+    def showItems(self, plt, name, createItems, updateItems):
+        # Plot items are kept between calls to reAddPlotItems() and given the new data,
+        # rather than clearing everything and making them all again.
+        items = plt.itemGroups.get(name)
+        if items is None:
+            items = plt.itemGroups[name] = createItems()
+            for item in items:
+                plt.addItem(item)
+        else:
+            updateItems(items)
+        plt.itemUpdaters[name] = updateItems# Also used by updateTail()
+        self.shownItems.add((plt, name))
+
+    def updateTail(self):
+        # Only the last bars have changed, so give the items their new data without laying out the plots again.
+        # The candlesticks only draw the tiles that changed, see ChartData.onTailChange().
+        for plt, name in self.shownItems:
+            plt.itemUpdaters[name](plt.itemGroups[name])
+
+    def removeUnshownItems(self):
+        for typeList in self.plotTypes:
+            for plt in typeList.plots:
+                for name in plt.itemGroups.keys():
+                    if (plt, name) in self.shownItems:
+                        continue
+                    plt.itemUpdaters.pop(name, None)
+                    for item in plt.itemGroups.pop(name):
+                        plt.removeItem(item)
+                        itemName = getattr(item, 'name', lambda: None)()
+                        if itemName and getattr(plt, 'legend', None):
+                            plt.legend.removeItem(itemName)
+
+    def taItemArgs(self, lines):
+        # The class, options and data of each item drawn for an indicator
+        data = self.data
+        for taLine in lines:
+            for col, yColumn in enumerate(wrapList(taLine.yColumns)):
+                opts = taLine.__dict__.copy()
+                if col:
+                    opts['name'] = None# Only allow each indicator to have one line in the legend.
+                if hasattr(taLine, 'x'):
+                    yield pg.PlotDataItem, opts, dict(x=taLine.x, y=yColumn)
+                elif taLine.barGraph:
+                    yield pg.BarGraphItem, opts, dict(x=data.plotTimes, height=yColumn,
+                        width=float(data.timeInterval), pens=taLine.pens, brushes=taLine.brushes)
+                else:
+                    opts.update(LINE_DECIMATION)
+                    yield pg.PlotDataItem, opts, dict(x=data.plotTimes, y=yColumn)
+
     def reAddPlotItems(self):
-        # Clear plot items
-        for i,typeList in enumerate(self.plotTypes):
+        self.legendKey = None
+        self.shownItems = set()
+        for typeList in self.plotTypes:
             typeList.usedCount = 0
-            for plot in typeList.plots:
-                plot.clear()
-                if i in [PLOT_MAIN, PLOT_EXTRA_TA]:
-                    clearLegend(plot.legend)
         self.widget.clear()
 
         data = self.data
@@ -752,6 +929,7 @@ class ChartGroup():
         mainPlot = self.createPlot(PLOT_MAIN)
         mainPlot.titleLabel.updateMin = lambda: None # Override the LabelItem.setText() setting a minimum width, which prevents chart from scaling.
         mainPlot.setTitle(title)
+        removeLegendTables(mainPlot.legend)
 
         row = 0
         self.widget.addItem(mainPlot, row, col=0)
@@ -764,28 +942,40 @@ class ChartGroup():
         layout.setColumnStretchFactor(0, STRETCH_FACTOR)
 
         if not data.count():
+            self.removeUnshownItems()
             return
 
+        def showCandlesticks(plt, isVolume):
+            self.showItems(plt, 'candlesticks',
+                lambda: [CandlestickItem(data, isVolume, self.showTrendBars)],
+                lambda items: items[0].setData(data, isVolume, self.showTrendBars))
+
         if data.isOHLC:
-            mainPlot.addItem(CandlestickItem(data.createCandlestick(False, self.showTrendBars)))
+            showCandlesticks(mainPlot, False)
             if self.showVolume and data.hasVolume:
                 plt = self.createPlot(PLOT_VOLUME)
-                plt.vb.yColumns = data.volume
-                plt.addItem(CandlestickItem(data.createCandlestick(True, self.showTrendBars)))
+                plt.vb.yColumns = 'volume'
+                showCandlesticks(plt, True)
 
                 self.widget.addItem(plt, row, col=0)
                 row += 1
         else:
-            mainPlot.plot(data.plotTimes, data.close.tolist()[:data.count()], pen='ffff00ff')
+            self.showItems(mainPlot, 'close',
+                lambda: [pg.PlotDataItem(data.plotTimes, data.close, pen='ffff00ff', **LINE_DECIMATION)],
+                lambda items: items[0].setData(data.plotTimes, data.close))
 
         if self.showOrderwall and data.orderwall:
             plt = self.createPlot(PLOT_ORDERWALL)
-            for bidAsk in range(len(data.orderwall)):# len() can be zero if we have no data
-                prices = data.orderwall[bidAsk][0]
-                amounts = data.orderwall[bidAsk][1]
-                plt.plot(
-                    amounts, prices, stepMode=True, fillLevel=prices[-1],
-                    brush=[(0,255,0,100),(255,0,0,100)][bidAsk])
+            orderwallArgs = [dict(
+                x=amounts, y=prices, stepMode=True, fillLevel=prices[-1],
+                brush=[(0,255,0,100),(255,0,0,100)][bidAsk])
+                for bidAsk, (prices, amounts) in enumerate(data.orderwall)]
+            def updateOrderwall(items):
+                for item, kwds in zip(items, orderwallArgs):
+                    item.setData(**kwds)
+            self.showItems(plt, 'orderwall',
+                lambda: [pg.PlotDataItem(**kwds) for kwds in orderwallArgs],
+                updateOrderwall)
             self.widget.addItem(plt, row=0, col=1, rowspan=10)
 
         # Add plot items
@@ -794,30 +984,25 @@ class ChartGroup():
             if getattr(self, 'show' + s):
                 lines = data.getTA(s)
                 if lines[0].extraTA:
-                    plt = self.createPlot(PLOT_EXTRA_TA)
-                    plt.vb.yColumns = lines[0].yColumns
+                    plt = self.createPlot(PLOT_EXTRA_TA, s)
+                    plt.vb.yColumns = lines[0].yNames
                     self.widget.addItem(plt, row, col=0)
                     row += 1
                     addToPlot = plt
                 else:
                     addToPlot = mainPlot
-                for taLine in lines:
-                    opts = taLine.__dict__.copy()
-                    for col, yColumn in enumerate(wrapList(taLine.yColumns)):
-                        floatY = yColumn.tolist()[:data.count()]
-                        if hasattr(taLine, 'x'):
-                            addToPlot.addItem(pg.PlotDataItem(y=floatY, **opts))
-                        elif taLine.barGraph:
-                            opts.update(x=data.plotTimes,
-                                        width=data.timeInterval)
-                            opts['width'] /= 1.
-                            addToPlot.addItem(pg.BarGraphItem(height=floatY, **opts))
+
+                itemArgs = list(self.taItemArgs(lines))
+                def updateTA(items, s=s):
+                    # The TAPlots are made again when the data changes, so get them each time
+                    for item, (cls, opts, kwds) in zip(items, self.taItemArgs(data.getTA(s))):
+                        if cls is pg.BarGraphItem:
+                            item.setOpts(**kwds)
                         else:
-                            xy = (data.plotTimes, floatY)
-                            addToPlot.addItem(pg.PlotDataItem(*xy, **opts))
-                        if col and hasattr(addToPlot, 'legend'):
-                            # Only allow each indicator to have one line in the legend.
-                            addToPlot.legend.removeItem(taLine.name)
+                            item.setData(**kwds)
+                self.showItems(addToPlot, s,
+                    lambda: [cls(**dict(opts, **kwds)) for cls, opts, kwds in itemArgs],
+                    updateTA)
 
         self.position = None
         self.links = {}
@@ -836,14 +1021,129 @@ class ChartGroup():
             if position['openLevel'] != None:
                 mainPlot.createLine('openLevel', position['openLevel'], '00FFFF', lineLabel=True, labelPos=openTime)
 
-                arrow = pg.ArrowItem(pos=(
-                                        openTime,
-                                        position['openLevel']),
-                                     angle=90,
-                                     pen=(255, 255, 255),
-                                     brush=(0, 0, 0, 0),
-                                     size=30)
-                mainPlot.addItem(arrow)
+                arrowPos = (openTime, position['openLevel'])
+                self.showItems(mainPlot, 'position',
+                    lambda: [pg.ArrowItem(pos=arrowPos,
+                                          angle=90,
+                                          pen=(255, 255, 255),
+                                          brush=(0, 0, 0, 0),
+                                          size=30)],
+                    lambda items: items[0].setPos(*arrowPos))
+
+        self.removeUnshownItems()
+
+class SharedChartData():
+    # The ChartData for each exchange, symbol and timeframe, shared by every chart showing it
+    # so it is only downloaded and calculated once. Dropped when no chart shows it any more.
+    def __init__(self):
+        self.entries = {}
+        self.streams = {}
+        self.stoppingStreams = []
+        self.streamTimer = QtCore.QTimer()
+        self.streamTimer.setInterval(STREAM_REDRAW_MS)
+        self.streamTimer.timeout.connect(self.applyStreamedTrades)
+        app.aboutToQuit.connect(self.stopStreams)
+
+    def key(self, data):
+        return (data.exchange.name, data.symbolKey, data.timeframe)
+
+    def find(self, data, cg):
+        # Only data shown by another chart, so a chart never reuses what it has already
+        entry = self.entries.get(self.key(data))
+        return entry.data if entry and entry.viewers - set([cg]) else None
+
+    def show(self, cg, data, publish=True):
+        # publish is False for data which may be older than the other charts have, eg: from the cache.
+        self.hide(cg)
+        if not data.count():
+            return
+
+        key = self.key(data)
+        entry = self.entries.setdefault(key, Struct(data=data, viewers=set()))
+        entry.viewers.add(cg)
+        cg.sharedKey = key
+        if entry.data is not data and publish:
+            if data.times[-1] >= entry.data.times[-1]:
+                # Newer data, so give it to the other charts too
+                entry.data = data
+                for viewer in list(entry.viewers):
+                    if viewer.data is not data:
+                        viewer.assignData(data)
+            else:
+                # The others have later bars, eg: streamed since the download started
+                cg.assignData(entry.data)
+                return
+        self.updateStream(key)
+
+    def hide(self, cg):
+        key = getattr(cg, 'sharedKey', None)
+        cg.sharedKey = None
+        entry = self.entries.get(key)
+        if entry:
+            entry.viewers.discard(cg)
+            if not entry.viewers:
+                del self.entries[key]
+            self.updateStream(key)
+
+    def updateStream(self, key):
+        # Stream live trades while any chart showing the data wants them
+        entry = self.entries.get(key)
+        wanted = entry and entry.data.exchange.streamUrl and any(cg.showStream for cg in entry.viewers)
+        stream = self.streams.get(key)
+        if wanted and not stream:
+            stream = self.streams[key] = StreamThread(entry.data.market())
+            stream.start()
+        elif stream and not wanted:
+            stream.stop()
+            del self.streams[key]
+            self.stoppingStreams.append(stream)# Keep a reference until it has finished
+            stream.finished.connect(lambda: self.stoppingStreams.remove(stream))
+
+        if self.streams:
+            self.streamTimer.start()
+        else:
+            self.streamTimer.stop()
+
+    def applyStreamedTrades(self):
+        # Each tick the trades received are added to the data, and only its charts are redrawn
+        for key, stream in self.streams.items():
+            trades = stream.takeTrades()
+            entry = self.entries.get(key)
+            if trades and entry:
+                count = entry.data.count()
+                start = entry.data.addTrades(trades)
+                if start is None:
+                    continue
+                for cg in entry.viewers:
+                    if start < 2 or entry.data.count() != count:
+                        cg.reAddPlotItems()# A new bar, so the view ranges move too
+                    else:
+                        cg.updateTail()
+
+    def stopStreams(self):
+        for stream in self.streams.values() + self.stoppingStreams:
+            stream.stop()
+            stream.wait()
+
+sharedChartData = SharedChartData()
+
+def loadChartData(market, getOrders, fromCache=False):
+    data = ChartData(market)# Blank data object
+    if market:# Check for empty chart
+        minuteDownload = None
+        if data.exchange.appendMinuteData and data.timeframe[1] in ['h', 'd']:
+            # Download the minute data alongside the chart's own data.
+            market = market.copy()
+            market.timeframe = 'm'
+            minuteDataToCopy = ChartData(market)
+            minuteDownload = threadPool('charts').apply_async(minuteDataToCopy.downloadAndParse, (), dict(fromCache=fromCache))
+
+        data.downloadAndParse(getOrders=getOrders, fromCache=fromCache)
+
+        if minuteDownload:
+            minuteDownload.get()
+            data.appendMinuteData(minuteDataToCopy)
+    return data
 
 allWindows = []
 class ChartWindow(QtGui.QMainWindow):
@@ -859,7 +1159,7 @@ class ChartWindow(QtGui.QMainWindow):
         QtGui.QShortcut(QtGui.QKeySequence('Q'), self, app.closeAllWindows)
         QtGui.QShortcut(QtGui.QKeySequence('W'), self, self.close)
         QtGui.QShortcut(QtGui.QKeySequence('N'), self, lambda: ChartWindow().show())
-        QtGui.QShortcut(QtGui.QKeySequence('Space'), self, lambda: self.mouseOverChartGroup.mainPlot().vb.menu.popup(QtGui.QCursor.pos()))
+        QtGui.QShortcut(QtGui.QKeySequence('Space'), self, lambda: self.mouseOverChartGroup and self.mouseOverChartGroup.mainPlot().vb.menu.popup(QtGui.QCursor.pos()))
 
         # Set background palette to black
         pal = self.palette()
@@ -869,6 +1169,11 @@ class ChartWindow(QtGui.QMainWindow):
         self.closeEvent = self.closeEvent
         self.mouseOverChartGroup = None
 
+        self.crosshairTimer = QtCore.QTimer()
+        self.crosshairTimer.setSingleShot(True)
+        self.crosshairTimer.setInterval(16)# About one frame at 60Hz
+        self.crosshairTimer.timeout.connect(self.updateCrosshairs)
+
         self.charts = MultiKeyDict()
         allWindows.append(self)
 
@@ -886,6 +1191,11 @@ class ChartWindow(QtGui.QMainWindow):
         if not self.isMaximized():# De-maximizing from a saved state causes the window to be tiny.
             gSettings.setValue('geometry', self.saveGeometry())
 
+        charts = self.charts
+        for row in charts:
+            for col in charts[row]:
+                charts.get([row, col]).remove()
+
     def keyPressEvent(self, evt):
         if self.mouseOverChartGroup:
             self.mouseOverChartGroup.keyPressEvent(evt)
@@ -893,13 +1203,22 @@ class ChartWindow(QtGui.QMainWindow):
     def focusOnChartGroup(self, cg):
         self.mouseOverChartGroup = cg
 
+        # Mouse moves can come much faster than the screen refreshes, so only update once per frame.
+        if not self.crosshairTimer.isActive():
+            self.crosshairTimer.start()
+
+    def updateCrosshairs(self):
+        cg = self.mouseOverChartGroup
+        if not cg or self.charts.get(cg.coord) is not cg:
+            return# Removed since the mouse moved over it
         globalMousePos = QtGui.QCursor.pos()
         mainPlotViewPos = cg.mainPlot().vb.mapSceneToView(cg.widget.mapFromGlobal(globalMousePos))
 
+        barIndexes = {}
         charts = self.charts
         for row in charts:
             for col in charts[row]:
-                charts.get([row, col]).setLinesAndFillLegend(globalMousePos, mainPlotViewPos)
+                charts.get([row, col]).setLinesAndFillLegend(globalMousePos, mainPlotViewPos, barIndexes)
 
     def onMarketsChanged(self, changedCG):
         changedPlot = changedCG.mainPlot()
@@ -940,6 +1259,9 @@ class ChartWindow(QtGui.QMainWindow):
         cg.changeMarket(market)
 
     def removeChart(self, cg):
+        cg.remove()
+        if self.mouseOverChartGroup is cg:
+            self.mouseOverChartGroup = None
         self.layout.setColumnStretch(cg.coord[1], 0)
         self.layout.removeWidget(cg.widget)
         cg.widget.deleteLater()
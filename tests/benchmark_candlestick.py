@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Times drawing the candlesticks and finding the y-range at 1k, 10k and 100k bars,
+# against the per-bar loops they replaced.
+# python tests/benchmark_candlestick.py
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyqtgraph as pg
+from pyqtgraph import QtCore, QtGui
+import chartdata
+import exchanges
+from utils import Struct
+
+SIZES = [1000, 10000, 100000]
+RANGE_QUERIES = 1000
+
+def makeData(count):
+    np.random.seed(count)
+    close = 100. + np.cumsum(np.random.randn(count))
+    open = np.roll(close, 1)
+    open[0] = close[0]
+    spread = np.abs(np.random.randn(2, count))
+    high = np.maximum(open, close) + spread[0]
+    low = np.minimum(open, close) - spread[1]
+    volume = np.random.rand(count) * 1000.
+    times = 1500000000 + 300*np.arange(count)
+
+    market = Struct(exchange=exchanges.findExchange('Poloniex'), symbolKey='ETH/BTC', description='', timeframe='5m')
+    data = chartdata.ChartData(market)
+    data.setOHLC(np.column_stack([times, open, high, low, close, volume]).tolist())
+    return data
+
+def perBarCandlestick(data, isVolume):
+    # The loop createCandlestick() used to have, drawing each bar with its own pen and brush
+    picture = QtGui.QPicture()
+    p = QtGui.QPainter(picture)
+
+    w = data.timeInterval / 3.
+    for e in xrange(data.count()):
+        t = data.plotTimes[e]
+        open, high, low, close, volume = data.getOHLCV(e)
+
+        upBar = close >= open
+        color = chartdata.OPEN_CLOSE_COLOR[upBar][0]
+
+        p.setPen(pg.mkPen(color))
+        p.setBrush(pg.mkBrush('#000000'))
+
+        if isVolume:
+            y = 0.
+            height = volume
+        else:
+            if low != high:
+                p.drawLine(QtCore.QPointF(t, low), QtCore.QPointF(t, high))
+            y = open
+            height = close - open
+
+        p.drawRect(QtCore.QRectF(t-w, y, w*2, height))
+
+    p.end()
+    return picture
+
+def batchedCandlestick(data, isVolume):
+    data.candleStickPictures = {}
+    return data.createCandlestick(isVolume, False)
+
+def sliceRange(data, queries):
+    # The y-range as findYRange() used to find it, slicing each column
+    for first, last in queries:
+        y_min = min(np.nanmin(data.high[first:last+1]), np.nanmin(data.low[first:last+1]))
+        y_max = max(np.nanmax(data.high[first:last+1]), np.nanmax(data.low[first:last+1]))
+
+def indexedRange(data, queries):
+    data.rangeIndexes = {}# Include building the index
+    for first, last in queries:
+        data.findRange(['high', 'low'], first, last)
+
+def best(func, *args):
+    # The fastest of a few runs, or just one if it's slow
+    times = []
+    while len(times) < 5 and sum(times) < 2.:
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+def report(name, old, new):
+    print '  %-24s %9.2fms %9.2fms %7.1fx' % (name, old*1000., new*1000., old/new if new else float('inf'))
+
+def main():
+    app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+
+    print '  %-24s %11s %11s %8s' % ('', 'per bar', 'batched', 'speedup')
+    for count in SIZES:
+        print '%i bars' % count
+        data = makeData(count)
+
+        for isVolume in [False, True]:
+            report('createCandlestick' + (' volume' if isVolume else ''),
+                   best(perBarCandlestick, data, isVolume),
+                   best(batchedCandlestick, data, isVolume))
+
+        # Zoomed views of a few hundred bars up to the whole chart
+        lengths = np.random.randint(1, count, RANGE_QUERIES)
+        firsts = (np.random.rand(RANGE_QUERIES) * (count - lengths)).astype(int)
+        queries = zip(firsts, firsts + lengths - 1)
+        report('findRange x%i' % RANGE_QUERIES,
+               best(sliceRange, data, queries),
+               best(indexedRange, data, queries))
+
+if __name__ == '__main__':
+    main()
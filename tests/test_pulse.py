@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Checks the Pulse squeeze states against the per-bar loop calcPulse() used to have,
+# on the saved bars in fixtures/pulse_bars.json.
+# python -m unittest discover tests
+import json
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import chartdata
+import exchanges
+from utils import Struct
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'pulse_bars.json')
+
+def referencePulse(data):
+    # The old loop, stepping through the bars. Also returns the state after each bar.
+    bbSqueeze = (data.bbUpper < data.kcUpper) & (data.bbLower > data.kcLower)
+    width = (data.bbUpper - data.bbLower) / (data.kcUpper - data.kcLower)
+    slowdownPrediction = abs(chartdata.shift(width)) > abs(width)
+
+    pensMomentum = []
+    bbInside, bbOutside = [], []
+    states, steps, durations = [], [], []
+
+    squeezeDuration = 0
+    stepsSinceSqueeze = 0
+    squeezeState = 'Ended'
+    for e in xrange(data.count()):
+        time = data.plotTimes[e]
+
+        if bbSqueeze[e]:
+            squeezeState = 'Squeeze'
+
+            if stepsSinceSqueeze:
+                stepsSinceSqueeze = 0
+                squeezeDuration = 0
+
+            squeezeDuration += 1
+            bbInside.append(time)
+        else:
+            if squeezeState == 'Squeeze':
+                squeezeState = 'Fired'
+
+            stepsSinceSqueeze += 1
+            bbOutside.append(time)
+
+        pen = [0,255,0] if data.momentum[e] >= 0. else [255,0,0]
+        if slowdownPrediction[e]:
+            pen = [c/2 for c in pen]
+            if squeezeState == 'Fired':
+                squeezeState = 'Ended'
+        pensMomentum.append(pen)
+
+        states.append(squeezeState)
+        steps.append(stepsSinceSqueeze)
+        durations.append(squeezeDuration)
+
+    if squeezeState != 'Squeeze':
+        squeezeState += ' (%i)' % stepsSinceSqueeze
+
+    return Struct(squeezeState=squeezeState, stepsSinceSqueeze=stepsSinceSqueeze, squeezeDuration=squeezeDuration,
+                  states=states, steps=steps, durations=durations,
+                  pensMomentum=pensMomentum, bbInside=bbInside, bbOutside=bbOutside)
+
+class PulseTest(unittest.TestCase):
+    def setUp(self):
+        self.cacheIndicators = chartdata.ChartData.cacheIndicators
+        chartdata.ChartData.cacheIndicators = False
+        with open(FIXTURE) as f:
+            self.bars = json.load(f)
+        self.market = Struct(exchange=exchanges.findExchange('Poloniex'), symbolKey='ETH/BTC', description='', timeframe='1h')
+
+    def tearDown(self):
+        chartdata.ChartData.cacheIndicators = self.cacheIndicators
+
+    def loadData(self, bars):
+        data = chartdata.ChartData(self.market)
+        data.setOHLC(bars)
+        data.calcIndicatorsMakePlots(['Pulse'])
+        return data
+
+    def assertMatchesReference(self, data):
+        ref = referencePulse(data)
+        self.assertEqual([chartdata.SQUEEZE_STATES[int(s)] for s in data.squeezeStates], ref.states)
+        self.assertEqual(data.squeezeSteps.astype(int).tolist(), ref.steps)
+        self.assertEqual(data.squeezeDurations.astype(int).tolist(), ref.durations)
+        self.assertEqual(data.squeezeState, ref.squeezeState)
+        self.assertEqual(data.stepsSinceSqueeze, ref.stepsSinceSqueeze)
+        self.assertEqual(data.squeezeDuration, ref.squeezeDuration)
+
+        momentum, outside, inside = data.taPulse[:3]
+        self.assertEqual(momentum.pens, ref.pensMomentum)
+        self.assertEqual(list(outside.x), ref.bbOutside)
+        self.assertEqual(list(inside.x), ref.bbInside)
+
+    def test_fixtureHasEveryState(self):
+        states = set(referencePulse(self.loadData(self.bars)).states)
+        self.assertEqual(states, set(chartdata.SQUEEZE_STATES))
+
+    def test_allBars(self):
+        self.assertMatchesReference(self.loadData(self.bars))
+
+    def test_everyPrefix(self):
+        # Each prefix ends in a different state, so the last values are checked in all of them
+        for count in xrange(1, len(self.bars), 7):
+            self.assertMatchesReference(self.loadData(self.bars[:count]))
+
+    def test_appendedBars(self):
+        # Bars added one at a time only recalculate the tail, carrying on the squeeze state
+        data = self.loadData(self.bars[:100])
+        for bar in self.bars[100:]:
+            data.appendBar(bar)
+        self.assertMatchesReference(data)
+
+    def test_calcSqueezeStatesContinues(self):
+        # Splitting the bars anywhere and continuing from the state before gives the same as all at once
+        data = self.loadData(self.bars)
+        bbSqueeze = data.squeezeStates == chartdata.SQUEEZE_ON
+        slowdown = data.slowdown != 0.
+        whole = chartdata.calcSqueezeStates(bbSqueeze, slowdown)
+        for split in xrange(1, data.count(), 11):
+            head = chartdata.calcSqueezeStates(bbSqueeze[:split], slowdown[:split])
+            tail = chartdata.calcSqueezeStates(bbSqueeze[split:], slowdown[split:], *[values[-1] for values in head])
+            for h, t, w in zip(head, tail, whole):
+                self.assertEqual(np.r_[h, t].tolist(), w.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Runs StreamThread against a local websocket server which sends Poloniex style trade messages.
+# python -m unittest discover tests
+import base64
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import chartdata
+import exchanges
+from utils import Struct
+
+MESSAGES = [
+    [1010],# Heartbeat
+    [148, 1, [['i', {}], ['t', '1', 1, '0.05', '2', 600]]],
+    [148, 2, [['o', 1, '0.1', '3'], ['t', '2', 0, '0.06', '1', 610], ['t', '3', 0, '0.04', '1', 900]]],
+]
+
+def serve(sock, received):
+    # Just enough of RFC 6455 for a handshake, one small masked frame in and small text frames out
+    conn, _ = sock.accept()
+    request = conn.recv(4096)
+    key = [line.split(':', 1)[1].strip() for line in request.split('\r\n') if line.lower().startswith('sec-websocket-key')][0]
+    accept = base64.b64encode(hashlib.sha1(key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+    conn.send('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n' % accept)
+
+    header = conn.recv(2)
+    mask = conn.recv(4)
+    payload = conn.recv(ord(header[1]) & 127)
+    received.append(''.join(chr(ord(c) ^ ord(mask[i % 4])) for i, c in enumerate(payload)))
+
+    for message in MESSAGES:
+        message = json.dumps(message)
+        conn.send('\x81' + chr(len(message)) + message)
+    conn.settimeout(5)
+    try:
+        while conn.recv(4096):# Until the client closes
+            pass
+    except socket.error:
+        pass
+    conn.close()
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.received = []
+
+        poloniex = exchanges.findExchange('Poloniex')
+        self.oldUrl = poloniex.streamUrl
+        poloniex.streamUrl = 'ws://127.0.0.1:%i' % self.sock.getsockname()[1]
+        self.market = Struct(exchange=poloniex, symbolKey='ETH/BTC', description='', timeframe='5m')
+
+    def tearDown(self):
+        self.market.exchange.streamUrl = self.oldUrl
+        self.sock.close()
+
+    def streamTrades(self):
+        server = threading.Thread(target=serve, args=(self.sock, self.received))
+        server.daemon = True
+        server.start()
+        stream = chartdata.StreamThread(self.market)
+        runner = threading.Thread(target=stream.run)
+        runner.start()
+        deadline = time.time() + 5
+        trades = []
+        while len(trades) < 3 and time.time() < deadline:
+            time.sleep(0.1)
+            trades += stream.takeTrades()
+        stream.stop()
+        runner.join(5)
+        self.assertFalse(runner.is_alive())
+        server.join(5)
+        self.assertFalse(server.is_alive())# The socket was closed
+        return trades
+
+    def test_subscribeAndParse(self):
+        trades = self.streamTrades()
+        self.assertEqual(json.loads(self.received[0]), {'command': 'subscribe', 'channel': 'BTC_ETH'})
+        self.assertEqual(trades, [[600, 0.05, 0.1], [610, 0.06, 0.06], [900, 0.04, 0.04]])
+
+    def test_addTrades(self):
+        data = chartdata.ChartData(self.market)
+        data.setOHLC([[0, .05, .05, .05, .05, 1.], [300, .05, .05, .05, .05, 1.]])
+        start = data.addTrades(self.streamTrades())
+        self.assertEqual(start, 2)
+        self.assertEqual(list(data.times), [0, 300, 600, 900])
+        self.assertEqual(list(data.close), [.05, .05, .06, .04])
+        self.assertEqual(list(data.high), [.05, .05, .06, .04])
+        self.assertAlmostEqual(data.volume[2], 0.16)
+
+    def test_lateTrades(self):
+        data = chartdata.ChartData(self.market)
+        data.setOHLC([[0, .05, .05, .05, .05, 1.], [300, .05, .05, .05, .05, 1.]])
+        self.assertEqual(data.addTrades([[100, .09, 1.]]), None)# Older than the last bar
+        self.assertEqual(list(data.high), [.05, .05])
+
+        data.addTrades([[330, .06, 1.]])
+        data.addTrades([[320, .07, 1.]])# Out of order, in the last bar
+        self.assertEqual(data.close[-1], .06)
+        self.assertEqual(data.high[-1], .07)
+        self.assertEqual(data.volume[-1], 3.)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
-import os, inspect, datetime as dt
+import os, inspect, requests, threading, time, datetime as dt
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
 from pyqtgraph import QtCore, QtGui
 
 ROW,COL = 0,1
@@ -125,8 +127,80 @@ class FileCache():
         fullPath = self.fullPath(keys)
         dir = os.path.dirname(fullPath)
         if dir and not os.path.exists(dir):# Python 3.2 makedirs() has exist_ok
-            os.makedirs(dir)
-        pickle.dump(Struct(value=value, time=now()), open(fullPath, 'wb'))# Also record the time the value was saved.
+            try: os.makedirs(dir)
+            except OSError: pass# Made by another thread or process meanwhile
+        # Write to a temporary file then rename it into place, so other threads and processes
+        # never read a half written file. The last one to save wins.
+        tempPath = '%s.%i.%i.tmp' % (fullPath, os.getpid(), threading.current_thread().ident)
+        with open(tempPath, 'wb') as f:
+            pickle.dump(Struct(value=value, time=now()), f)# Also record the time the value was saved.
+        os.rename(tempPath, fullPath)
+
+gPerProcessLock = threading.Lock()
+def perProcess(store, name, create):
+    # Connections and threads cant be shared with a forked process, so each process has its own.
+    key = (os.getpid(), name)
+    with gPerProcessLock:
+        if key not in store:
+            store[key] = create()
+        return store[key]
+
+HTTP_POOL_SIZE = 10 # Connections kept open to each host
+gSessions = {}
+def httpSession(name, poolSize=HTTP_POOL_SIZE):
+    # One keep-alive session per exchange, so requests to the same host reuse connections.
+    def create():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+    return perProcess(gSessions, name, create)
+
+def httpStats():
+    # Requests made and connections opened by each session in this process.
+    stats = {}
+    for (pid, name), session in gSessions.items():
+        if pid != os.getpid():
+            continue
+        requestCount, connectionCount = 0, 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                requestCount += pools[key].num_requests
+                connectionCount += pools[key].num_connections
+        stats[name] = (requestCount, connectionCount)
+    return stats
+
+def strHttpStats():
+    return ', '.join('%s: %i requests on %i connections' % (name, requestCount, connectionCount)
+                     for name, (requestCount, connectionCount) in sorted(httpStats().items()))
+
+gThreadPools = {}
+def threadPool(name, size=HTTP_POOL_SIZE):
+    # Tasks must not wait on tasks in the same pool, or a full pool would deadlock.
+    return perProcess(gThreadPools, name, lambda: ThreadPool(size))
+
+class RequestLimiter:
+    # Use as a with block around each request.
+    # Caps the requests in flight and spaces out their starts to keep under perSecond.
+    def __init__(self, maxConcurrent, perSecond=None):
+        self.semaphore = threading.BoundedSemaphore(maxConcurrent)
+        self.interval = 1. / perSecond if perSecond else 0.
+        self.nextStart = 0.
+        self.lock = threading.Lock()
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            start = max(time.time(), self.nextStart)
+            self.nextStart = start + self.interval
+        time.sleep(max(0., start - time.time()))
+    def __exit__(self, *args):
+        self.semaphore.release()
+
+gLimiters = {}
+def requestLimiter(name, maxConcurrent, perSecond=None):
+    return perProcess(gLimiters, name, lambda: RequestLimiter(maxConcurrent, perSecond))
 
 CACHE_DIR = os.path.expanduser('~') + '/.qmarket'
 gCache = FileCache(CACHE_DIR)
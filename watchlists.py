@@ -10,6 +10,7 @@ from chartdata import *
 import watchlist_ui # pyuic4 watchlist.ui > watchlist_ui.py
 
 CACHE_SECONDS = 60 * 60 # Re-download if longer than this
+WATCHLIST_WORKERS = 8 # Markets refreshed at once
 ALL_TIMEFRAMES = ['1d', '1w', '1M']
 NUM_TIMEFRAME_COLS = 3
 
@@ -26,7 +27,7 @@ def getScreenerWatchlist():
     url = 'https://www.google.co.uk/finance?output=json&start=0&num=100&noIL=1&q=[' + query + ']&restype=company&sortas=' +\
         'QuotePercChange'
         #'Volume'
-    response = requests.get(url)
+    response = httpSession(exchanges.findExchange('Google').name).get(url)
 
     # Remove "original_query" as it breaks json parsing
     content = response.content
@@ -41,6 +42,9 @@ def getScreenerWatchlist():
         watchlist.append(result['title'] + '|' + result['exchange'] + ':' + result['ticker'] + ' / Google')
     return watchlist
 
+# Just the indicators the watchlist columns are made from
+STATS_INDICATORS = ['BB', 'BBOver', 'MA2', 'ADX', 'Trend', 'Pulse']
+
 def calcStatsFromData(dataList, marketStr):
     data = dataList[0]
     stats = Struct(exchange=data.exchange.name,
@@ -69,7 +73,7 @@ def calcStatsFromData(dataList, marketStr):
             stats.bbOver.append(bbOver[last])
             stats.ma.append(ma[last])
             stats.adx.append(adx[last])
-            stats.upTrend.append(data.upTrend[-1])
+            stats.upTrend.append(bool(data.upTrend[-1]))
 
             stats.squeezeState.append(data.squeezeState)
             stats.stepsSinceSqueeze.append(data.stepsSinceSqueeze)
@@ -78,6 +82,7 @@ def calcStatsFromData(dataList, marketStr):
     return stats
 
 def procRefreshWatchlist(sharedD, watchlistName, watchlist):
+    ChartData.cacheIndicators = False# Only for this process
 
     def refreshMarketStats(marketStr):
         market = parseToMarketStruct(marketStr)
@@ -105,40 +110,57 @@ def procRefreshWatchlist(sharedD, watchlistName, watchlist):
             for data in dataList:
                 data.appendMinuteData(minuteData)
 
-        weekly = daily.resampleNew('1w')
-        monthly = daily.resampleNew('1M')
+        weekly, monthly = daily.resampleMany(['1w', '1M'])
         dataList = [daily, weekly, monthly]
         if hourly is not None:
-            hour4 = hourly.resampleNew('4h')
+            # The 24-hour volume comes from resampling hourly as well
+            hour4, hourlyDaily = hourly.resampleMany(['4h', '1d'])
             dataList = [hour4] + dataList
 
         for data in dataList:
-            data.calcIndicatorsMakePlots()
+            data.calcIndicatorsMakePlots(STATS_INDICATORS)
         stats = calcStatsFromData(dataList, marketStr)
 
         stats.volume = 0.
         if hourly is not None and hourly.isOHLC:
-            # Resample hourly to get 24-hour volume
-            data = hourly.resampleNew('1d')
+            data = hourlyDaily
             last = data.count()-1
             stats.volume = data.volume[last]
 
         return stats
 
-    stats = None
-    while not sharedD['abort'] and sharedD['idx'] < len(watchlist):
-        if sharedD['pause']:
+    def refreshIfOld(marketStr):
+        while sharedD['pause'] and not sharedD['abort']:
             time.sleep(0.1)
-            continue
+        if sharedD['abort']:
+            return
 
-        marketStr = watchlist[sharedD['idx']]
         key = cacheKey(watchlistName, marketStr)
         stats = gCache.get(key)
         if not stats or (dt.datetime.now() - stats.time).seconds > CACHE_SECONDS:
             stats = refreshMarketStats(marketStr)
             gCache.set(key, stats)
-
+            return True# Downloaded
+
+    # Logging in can show a dialog, which must be done on this thread rather than in the pool.
+    for exchange in set(exchanges.findExchange(marketStr.split('/')[-1].strip()) for marketStr in watchlist):
+        exchange.onDownloadStart()
+
+    # Several markets are downloaded at once, with each exchange's RequestLimiter keeping its requests in check.
+    # Results come back in watchlist order, which onRefreshTable relies on.
+    pool = threadPool('watchlist', WATCHLIST_WORKERS)
+    startTime = time.time()
+    downloaded = 0
+    for isDownloaded in pool.imap(refreshIfOld, watchlist):
+        if sharedD['abort']:
+            break
         sharedD['idx'] += 1
+        if isDownloaded:
+            # Cached markets come back straight away, so only downloads count towards the rate
+            downloaded += 1
+            sharedD['marketsPerSecond'] = downloaded / (time.time() - startTime)
+
+    print strHttpStats()
 
 # Return: float, string
 def getStatsValue(stats, colName, subCol):
@@ -363,7 +385,7 @@ class WatchlistWindow(QtGui.QMainWindow):
             watchlist = self.watchlists[name]
 
         manager = Manager()
-        self.sharedD = manager.dict(abort=False, pause=False, idx=0)
+        self.sharedD = manager.dict(abort=False, pause=False, idx=0, marketsPerSecond=0.)
         self.results = []
         self.watchlistName = name
         self.watchlist = watchlist
@@ -399,11 +421,11 @@ class WatchlistWindow(QtGui.QMainWindow):
             key = cacheKey(self.watchlistName, marketStr)
             stats = gCache.get(key).value
 
-            # When we unpickle, the DataFrame is valid but ChartData is not so call the constructor.
+            # When we unpickle, the columns are valid but ChartData is not so call the constructor.
             market = parseToMarketStruct(marketStr)
             for i,data in enumerate(stats.dataList):
                 market.timeframe = ALL_TIMEFRAMES[i]
-                data.__init__(market, existingDf=data)
+                data.__init__(market, existingData=data)
             self.results.append(stats)
 
         columns, multiColumns = self.activeColumns()
@@ -439,7 +461,7 @@ class WatchlistWindow(QtGui.QMainWindow):
         self.ui.tableView.horizontalHeader().setResizeMode(0, mode)
 
         self.ui.statusbar.clearMessage()
-        self.ui.statusbar.showMessage('Refreshed %i/%i' % (sharedD['idx'], len(self.watchlist)))
+        self.ui.statusbar.showMessage('Refreshed %i/%i (%.1f markets/s)' % (sharedD['idx'], len(self.watchlist), sharedD['marketsPerSecond']))
 
     def getStatsByRow(self, row):
         if row < 0 or row >= len(self.sortedMarkets):
@@ -459,7 +481,7 @@ class WatchlistWindow(QtGui.QMainWindow):
         # Create candlestick pictures on list mouseover to speed up selection.
         for text in self.getChartsToShow():
             data = stats.dataList[ALL_TIMEFRAMES.index(text)]
-            data.calcIndicatorsMakePlots()
+            data.calcIndicatorsMakePlots(self.cg.shownIndicators())
             for isVolume in range(2):
                 data.createCandlestick(isVolume, self.cg.showTrendBars)
 